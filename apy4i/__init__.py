@@ -5,25 +5,71 @@ from functools import wraps
 
 from quart_trio import QuartTrio
 from quart import request, jsonify
-from trio import sleep
+from trio import sleep, CancelScope, open_nursery
 
 from textflip import flip
-from .slack import slack
+from .slack import slack, run_commands
+from .events import stream
 from .grafana import views as grafana_views
-from .storage import Store, Log
-from .utils import timestamp, elo as _elo
+from .storage import (
+    Store,
+    Log,
+    flush_stores,
+    flush_periodically,
+    compact_stores,
+    run_log_writers,
+    close_logs,
+    compress_logs_periodically,
+    watch_shared_files,
+)
+from .utils import timestamp, cached, run_refreshes, elo as _elo
 from .krank import views as krank_views
 from .auth import simple_token, github_hmac
 from .chords import views as chord_views
-from .alerts import views as alert_views
-from .foodsched import views as foodsched_views
-from .mls7 import views as mls7_views
+from .alerts import views as alert_views, schedule_alerts, deliver_alerts
+from .foodsched import views as foodsched_views, pregenerate_food
+from .mls7 import views as mls7_views, refresh_dashboard
+from .ratings import views as rating_views
+from .rollups import backfill_rollups, prune_rollups_periodically
+from . import client
 
 logging.basicConfig(
     filename="api.log", level=logging.INFO, format="%(asctime)s\t%(message)s"
 )
 
 app = QuartTrio(__name__)
+background = CancelScope()
+
+
+async def run_background_tasks():
+    with background:
+        async with open_nursery() as nursery:
+            await nursery.start(run_log_writers)
+            nursery.start_soon(flush_periodically)
+            nursery.start_soon(compress_logs_periodically)
+            nursery.start_soon(watch_shared_files)
+            nursery.start_soon(refresh_dashboard)
+            nursery.start_soon(backfill_rollups)
+            nursery.start_soon(prune_rollups_periodically)
+            nursery.start_soon(schedule_alerts)
+            nursery.start_soon(deliver_alerts)
+            await nursery.start(run_commands)
+            await nursery.start(run_refreshes)
+            nursery.start_soon(pregenerate_food)
+
+
+@app.before_serving
+async def start_background_tasks():
+    app.nursery.start_soon(run_background_tasks)
+
+
+@app.after_serving
+async def stop_background_tasks():
+    await close_logs()
+    background.cancel()
+    await flush_stores()
+    await compact_stores(force=True)
+    await client.close()
 
 
 def debug_route(*args, **kwargs):
@@ -61,13 +107,13 @@ async def put(key, val):
 
 @debug_route("/get/<path:key>")
 async def get(key):
-    async with Store("what") as s:
+    async with Store.read("what") as s:
         return s.get(key, "not found")
 
 
 @debug_route("/stall/<path:key>")
 async def stall(key):
-    async with Store("what"):
+    async with Store.read("what"):
         await sleep(5)
         return "stalled"
 
@@ -104,10 +150,7 @@ async def github():
 
 @debug_route("/logs")
 async def logs():
-    entries = []
-    async for entry in Log("who"):
-        entries.append(entry)
-    return jsonify(entries)
+    return jsonify(await Log("who").tail(int(request.args.get("last", 100))))
 
 
 @app.route("/elo/<outcome>/<team_a>/<team_b>")
@@ -126,7 +169,18 @@ def elo(outcome, team_a, team_b, k=16):
     return jsonify([round(team_a[0] + mod_a), round(team_b[0] + mod_b)])
 
 
+@app.route("/stats/cache")
+async def cache_stats():
+    return jsonify(cached.stats)
+
+
+@app.route("/stats/http")
+async def http_stats():
+    return jsonify(client.stats)
+
+
 app.route("/slack", methods=["POST"])(slack)
+app.route("/events")(stream)
 
 app.register_blueprint(chord_views, url_prefix="/chords")
 app.register_blueprint(krank_views, url_prefix="/krank")
@@ -134,6 +188,7 @@ app.register_blueprint(grafana_views, url_prefix="/grafana")
 app.register_blueprint(alert_views, url_prefix="/alerts")
 app.register_blueprint(foodsched_views, url_prefix="/food")
 app.register_blueprint(mls7_views, url_prefix="/mls7")
+app.register_blueprint(rating_views, url_prefix="/ratings")
 
 
 @app.after_request
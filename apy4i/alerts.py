@@ -1,11 +1,120 @@
 import uuid
+import random
+import logging
+from heapq import heappush, heappop
 from datetime import datetime, timedelta
-import asks
 from quart import Blueprint, request, abort, jsonify
-from .storage import Store
+from trio import CapacityLimiter, Event, move_on_after, open_memory_channel, open_nursery, sleep
+from .storage import Store, version
+from .utils import etagged
+from . import client
 
 views = Blueprint("alerts", __name__)
 
+schedule = []  # heap of (deadline, alert_id, severity)
+planned = {}  # alert_id -> its entry in schedule; other entries for it are stale
+rescheduled = Event()  # set when the earliest deadline may have changed
+
+# notifications waiting to be sent; (alert_id, severity) in pending are queued or in flight
+outbox, inbox = open_memory_channel(float("inf"))
+pending = set()
+senders = CapacityLimiter(8)
+DELIVERY_ATTEMPTS = 8
+MAX_RETRY_DELAY = 300
+
+
+def plan(alert_id, alert):
+    """Schedule the alert's next notification, if it has one."""
+    severity = {"waiting": "warning", "warned": "error"}.get(alert["status"])
+    if severity is None:
+        planned.pop(alert_id, None)
+        return
+    entry = (alert[f"{severity}_at"], alert_id, severity)
+    planned[alert_id] = entry
+    heappush(schedule, entry)
+    rescheduled.set()
+
+
+def notify(alert_id, alert, severity):
+    if (alert_id, severity) not in pending:
+        pending.add((alert_id, severity))
+        outbox.send_nowait((alert_id, alert, severity))
+
+
+async def fire_due():
+    now = datetime.utcnow().timestamp()
+    if not schedule or schedule[0][0] > now:
+        return
+    due, fired = [], []
+    try:
+        # only record the transitions here, sending happens without the lock
+        async with Store("alerts") as alerts:
+            while schedule and schedule[0][0] <= now:
+                due.append(heappop(schedule))
+            for entry in due:
+                _, alert_id, severity = entry
+                if planned.get(alert_id) != entry:
+                    continue
+                if (alert := alerts.get(alert_id)) is None:
+                    planned.pop(alert_id, None)
+                    continue
+                if alert["status"] != {"warning": "waiting", "error": "warned"}[severity]:
+                    plan(alert_id, alert)  # another worker got there first
+                    continue
+                alert["status"] = {"warning": "warned", "error": "errored"}[severity]
+                fired.append((alert_id, dict(alert), severity))
+    except BaseException:
+        # put them back, they are tried again next time
+        for entry in due:
+            heappush(schedule, entry)
+        raise
+    for alert_id, alert, severity in fired:
+        plan(alert_id, alert)
+        notify(alert_id, alert, severity)
+
+
+async def schedule_alerts():
+    """Send notifications when they're due, sleeping until the next deadline."""
+    global rescheduled
+    async with Store.read("alerts") as alerts:
+        for alert_id, alert in alerts.items():
+            plan(alert_id, alert)
+    while True:
+        rescheduled = Event()
+        await fire_due()
+        if schedule:
+            delay = schedule[0][0] - datetime.utcnow().timestamp()
+        else:
+            delay = float("inf")
+        with move_on_after(max(delay, 0)):
+            await rescheduled.wait()
+
+
+async def deliver(alert_id, alert, severity):
+    try:
+        for attempt in range(DELIVERY_ATTEMPTS):
+            if attempt:
+                await sleep(min(MAX_RETRY_DELAY, 2 ** attempt) * random.uniform(0.5, 1.5))
+                async with Store.read("alerts") as alerts:
+                    if alert_id not in alerts:
+                        return
+            try:
+                async with senders:
+                    await send(alert_id, alert, severity)
+                return
+            except Exception as e:
+                logging.warning("Sending %s for alert %s failed: %r", severity, alert_id, e)
+        logging.error("Giving up on sending %s for alert %s", severity, alert_id)
+    finally:
+        pending.discard((alert_id, severity))
+
+
+async def deliver_alerts():
+    """Send queued notifications concurrently, retrying failures with backoff."""
+    async with open_nursery() as nursery:
+        async for alert_id, alert, severity in inbox:
+            nursery.start_soon(deliver, alert_id, alert, severity)
+
 @views.route("/create", methods=["POST"])
 async def create():
     data = await request.json
@@ -24,37 +133,33 @@ async def create():
     }
     async with Store("alerts") as alerts:
         alerts[alert_id] = alert
+    plan(alert_id, alert)
     return alert_id
 
 
 @views.route("/list")
+@etagged(lambda: version("kv", "alerts"))
 async def list():
-    async with Store("alerts") as alerts:
-        return alerts
+    async with Store.read("alerts") as alerts:
+        return jsonify(dict(alerts))
 
 
 @views.route("/resolve/<alert_id>")
 async def resolve(alert_id):
     async with Store("alerts") as alerts:
+        planned.pop(alert_id, None)
         return alerts.pop(alert_id)
 
 
 @views.route("/beat")
 async def beat():
-    now = datetime.utcnow().timestamp()
-    async with Store("alerts") as alerts:
-        for alert_id, alert in alerts.items():
-            if alert["status"] == "waiting" and alert["warning_at"] <= now:
-                await send(alert_id, alert, "warning")
-                alert["status"] = "warned"
-            elif alert["status"] == "warned" and alert["error_at"] <= now:
-                await send(alert_id, alert, "error")
-                alert["status"] = "errored"
+    # alerts are sent by schedule_alerts; this only makes sure nothing due is left
+    await fire_due()
     return {}
 
 
 async def send(alert_id, alert, severity):
-    r = await asks.post(
+    r = await client.post(
         f"https://ntfy.sh/{alert[severity + '_topic']}",
         json={
             "topic": alert[f"{severity}_topic"],
@@ -1,12 +1,37 @@
+import os
 import html
-import asks
-from quart import Blueprint, request, abort, jsonify
+import json
+import hashlib
+from quart import Blueprint, request, abort, jsonify, make_response
 from chordy.song import Song
 from chordy.chord import Chord
 from .storage import read_blob, write_blob
+from .utils import LRU
+from . import client
 
 views = Blueprint("chords", __name__)
 
+# rendered songs, keyed on everything that goes into rendering them
+RENDER_CACHE_BYTES = int(os.environ.get("RENDER_CACHE_BYTES", 16 * 1024 * 1024))
+renders = LRU(RENDER_CACHE_BYTES, size=len)
+
+
+async def rendered(key, render):
+    """Respond with render()'s output, cached and with a strong ETag.
+
+    The key has to determine the output completely (blob ids do, since they're
+    content hashes), which lets us answer revalidations without rendering.
+    """
+    etag = hashlib.sha256(repr(key).encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        return "", 304, {"ETag": f'"{etag}"'}
+    if (body := renders.get(key)) is None:
+        body = await render()
+        renders.put(key, body)
+    response = await make_response(body)
+    response.set_etag(etag)
+    return response
+
 
 @views.route("/convert", methods=["POST"], defaults={"format_": "html"})
 @views.route("/convert/<format_>", methods=["POST"])
@@ -14,9 +39,17 @@ async def convert(format_):
     if format_ not in ["html", "txt", "tex"]:
         abort(405)
     data = await request.json
-    song = Song.from_file(filter(bool, data["lines"]))
-    song.title = data.get("title")
-    return getattr(song, f"to_{format_}")(flags=data.get("flags", ""))
+    flags = data.get("flags", "")
+    content = hashlib.sha256(
+        json.dumps([data["lines"], data.get("title")]).encode()
+    ).hexdigest()
+
+    async def render():
+        song = Song.from_file(filter(bool, data["lines"]))
+        song.title = data.get("title")
+        return getattr(song, f"to_{format_}")(flags=flags)
+
+    return await rendered((content, None, False, flags, format_), render)
 
 
 @views.route("/save", methods=["POST"])
@@ -32,7 +65,7 @@ async def scrape():
     data = await request.json
     if not data["url"].startswith("https://tabs.ultimate-guitar.com/"):
         abort(404)
-    r = await asks.get(data["url"])
+    r = await client.get(data["url"])
     return html.unescape(
         r.text.partition("content&quot;:&quot;")[2]
         .partition("&quot;,&quot")[0]
@@ -45,16 +78,22 @@ async def scrape():
 
 
 @views.route("/show/<identifier>", defaults={"format_": "html"})
-@views.route("/show/<identifier>/<format>")
+@views.route("/show/<identifier>/<format_>")
 async def show(identifier, format_):
-    song = await read_blob(identifier)
-    if transpose := request.args.get("transpose"):
-        song = song.transpose(int(transpose))
-    if request.args.get("simplify"):
-        song = song.simplify()
+    transpose = int(request.args.get("transpose") or 0)
+    simplify = bool(request.args.get("simplify"))
     if not (flags := request.args.get("flags")):
         flags = ""
-    return getattr(song, f"to_{format_}")(flags=flags)
+
+    async def render():
+        song = await read_blob(identifier)
+        if transpose:
+            song = song.transpose(transpose)
+        if simplify:
+            song = song.simplify()
+        return getattr(song, f"to_{format_}")(flags=flags)
+
+    return await rendered((identifier, transpose, simplify, flags, format_), render)
 
 
 @views.route("/detect/<path:chord>")
@@ -0,0 +1,52 @@
+"""Outbound HTTP: one pooled, keep-alive session per upstream host."""
+import os
+import time
+from urllib.parse import urlsplit
+
+import asks
+
+# at most this many concurrent requests (and pooled connections) per host
+LIMITS = {"ntfy.sh": 8, "hooks.slack.com": 8}
+DEFAULT_LIMIT = int(os.environ.get("HTTP_CONNECTIONS", 4))
+TIMEOUT = float(os.environ.get("HTTP_TIMEOUT", 10))
+
+sessions = {}  # host -> asks.Session
+stats = {}  # host -> counters
+
+
+async def request(method, url, **kwargs):
+    host = urlsplit(url).netloc
+    if host not in sessions:
+        sessions[host] = asks.Session(connections=LIMITS.get(host, DEFAULT_LIMIT))
+        stats[host] = {"requests": 0, "errors": 0, "seconds": 0.0, "max_seconds": 0.0}
+    counters = stats[host]
+    kwargs.setdefault("timeout", TIMEOUT)
+    start = time.monotonic()
+    try:
+        r = await sessions[host].request(method, url, **kwargs)
+    except BaseException:
+        counters["errors"] += 1
+        raise
+    else:
+        if r.status_code >= 400:
+            counters["errors"] += 1
+        return r
+    finally:
+        elapsed = time.monotonic() - start
+        counters["requests"] += 1
+        counters["seconds"] += elapsed
+        counters["max_seconds"] = max(counters["max_seconds"], elapsed)
+
+
+async def get(url, **kwargs):
+    return await request("GET", url, **kwargs)
+
+
+async def post(url, **kwargs):
+    return await request("POST", url, **kwargs)
+
+
+async def close():
+    for session in sessions.values():
+        await session.close()
+    sessions.clear()
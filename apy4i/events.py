@@ -0,0 +1,64 @@
+"""Change notifications for live pages, pushed as server-sent events."""
+import os
+from quart import request, make_response
+from trio import Event, move_on_after
+from .storage import change_listeners
+
+# seconds without changes after which a comment is sent, to keep the stream open
+HEARTBEAT = float(os.environ.get("SSE_HEARTBEAT", 15))
+
+subscribers = set()
+
+
+class Subscriber:
+    """Topics that changed since the client was last sent anything.
+
+    Repeated changes of a topic collapse into one, so a client that reads
+    slowly never has more than one pending event per topic.
+    """
+
+    def __init__(self, topics):
+        self.topics = topics  # None: all of them
+        self.pending = {}
+        self.changed = Event()
+
+    def notify(self, topic):
+        if self.topics is None or topic in self.topics:
+            self.pending[topic] = None
+            self.changed.set()
+
+
+def publish(topic):
+    for subscriber in subscribers:
+        subscriber.notify(topic)
+
+
+change_listeners.append(lambda kind, key: publish(f"{kind}-{key}"))
+
+
+async def stream():
+    topics = request.args.get("topics")
+    subscriber = Subscriber(set(topics.split(",")) if topics else None)
+
+    async def events():
+        subscribers.add(subscriber)
+        try:
+            yield b"retry: 5000\n\n"
+            while True:
+                with move_on_after(HEARTBEAT):
+                    await subscriber.changed.wait()
+                subscriber.changed = Event()
+                pending, subscriber.pending = subscriber.pending, {}
+                if not pending:
+                    yield b": heartbeat\n\n"
+                for topic in pending:
+                    yield f"event: {topic}\ndata: {topic}\n\n".encode()
+        finally:
+            subscribers.discard(subscriber)
+
+    response = await make_response(
+        events(),
+        {"Content-Type": "text/event-stream", "Cache-Control": "no-cache"},
+    )
+    response.timeout = None  # the stream is meant to stay open
+    return response
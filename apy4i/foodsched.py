@@ -1,16 +1,47 @@
-from datetime import date, timedelta
+import os
+import logging
+from datetime import date, datetime, time, timedelta
 from random import choice
 
 from quart import Blueprint, request
-from .storage import Store
+from trio import sleep
+from .storage import Store, version
 from .auth import simple_token
+from .utils import etagged
 
 views = Blueprint("food", __name__)
 
+PARTS = "breakfast", "lunch", "dinner"
+DAYS = 3  # shown on the page
+PREGENERATE_DAYS = int(os.environ.get("FOOD_PREGENERATE_DAYS", 14))
+
+rendered = {}  # (first day, versions of the stores it was made from) -> the page's table
+
+
+async def schedule_for(dates):
+    """The food for every part of the given days, picking it where there's none yet."""
+    keys = [f"{dt}-{part}" for dt in dates for part in PARTS]
+    async with Store.read("foodsched") as schedule:
+        if all(key in schedule for key in keys):
+            return {key: schedule[key] for key in keys}
+    async with Store("foodsched") as schedule, Store.read("foods") as foods:
+        for key in keys:
+            if key not in schedule:
+                schedule[key] = choice(foods[key.rpartition("-")[2]])
+        return {key: schedule[key] for key in keys}
 
-async def generate_food(dt, part):
-    async with Store("foods") as foods:
-        return choice(foods[part])
+
+async def pregenerate_food():
+    """Keep the schedule filled for the coming days, and today's table rendered."""
+    while True:
+        today = date.today()
+        try:
+            await schedule_for([today + timedelta(days=i) for i in range(PREGENERATE_DAYS)])
+            await table(today)
+        except Exception:
+            logging.exception("Pre-generating the food schedule failed")
+        tomorrow = datetime.combine(today + timedelta(days=1), time())
+        await sleep((tomorrow - datetime.now()).total_seconds() + 1)
 
 
 @views.route("/add", methods=["POST"])
@@ -25,13 +56,13 @@ async def add_food():
 
 @views.route("/schedule/<dt>/<part>/reroll", methods=["POST"])
 async def reroll(dt, part):
-    async with Store("foodsched") as schedule:
-        key = f"{dt}-{part}"
-        del schedule[key]
-    return await food_for(dt, part)
+    async with Store("foodsched") as schedule, Store.read("foods") as foods:
+        schedule[f"{dt}-{part}"] = food = choice(foods[part])
+    return cell(dt, part, food)
 
 
 @views.route("/schedule")
+@etagged(lambda: (date.today(), version("kv", "foodsched"), version("kv", "foods")))
 async def index():
     parts = [
         """
@@ -41,6 +72,7 @@ async def index():
         integrity="sha384-L6OqL9pRWyyFU3+/bjdSri+iIphTN/bvYyM37tICVyOJkWZLpP2vGn6VUEXgzg6h"
         crossorigin="anonymous"
         ></script>
+        <script src="https://unpkg.com/htmx.org@1.9.2/dist/ext/sse.js"></script>
         <link rel="stylesheet" href="https://cdn.simplecss.org/simple.min.css">
         <style>
             .reload {
@@ -49,36 +81,59 @@ async def index():
             }
         </style>
         <h2>Food schedule</h2>
-        <table>
+        <table
+            hx-ext="sse"
+            sse-connect="/events?topics=kv-foodsched"
+            hx-get="/food/schedule/table"
+            hx-trigger="sse:kv-foodsched"
+        >
         """
     ]
-    today = date.today()
-    for time_of_day in None, "breakfast", "lunch", "dinner":
+    parts.append(await table(date.today()))
+    parts.append("</table>")
+    return "\n".join(parts)
+
+
+@views.route("/schedule/table")
+@etagged(lambda: (date.today(), version("kv", "foodsched")))
+async def schedule_table():
+    return await table(date.today())
+
+
+def rendered_key(today):
+    return today, version("kv", "foodsched"), version("kv", "foods")
+
+
+async def table(today):
+    if (html := rendered.get(rendered_key(today))) is not None:
+        return html
+    dates = [today + timedelta(days=i) for i in range(DAYS)]
+    foods = await schedule_for(dates)
+    key = rendered_key(today)  # picking missing food bumps the version
+    parts = []
+    for time_of_day in None, *PARTS:
         if time_of_day:
             parts.append("<tr>")
             parts.append(f"<td>{time_of_day}</td>")
         else:
             parts.append("<th>")
-        for i in range(3):
-            dt = today + timedelta(days=i)
+        for dt in dates:
             if time_of_day:
-                parts.append(await food_for(str(dt), time_of_day))
+                parts.append(cell(dt, time_of_day, foods[f"{dt}-{time_of_day}"]))
             else:
                 parts.append(f"<td><strong>{dt:%A}</strong></td>")
         if time_of_day:
             parts.append("</tr>")
         else:
             parts.append("</th>")
-    parts.append("</table>")
-    return "\n".join(parts)
+    html = "\n".join(parts)
+    rendered.clear()  # older tables
+    rendered[key] = html
+    return html
 
 
-async def food_for(dt, part):
-    async with Store("foodsched") as schedule:
-        key = f"{dt}-{part}"
-        if key not in schedule:
-            schedule[key] = await generate_food(dt, part)
-        return f"""<td>{schedule[key]}<div
+def cell(dt, part, food):
+    return f"""<td>{food}<div
             class="reload"
             hx-post="/food/schedule/{dt}/{part}/reroll"
             hx-trigger="click"
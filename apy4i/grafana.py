@@ -1,22 +1,42 @@
 import os
 import json
+from itertools import groupby
 from datetime import datetime, timezone, timedelta
 
-import asks
 from quart import request, jsonify, Blueprint, abort
+from trio import open_nursery
 from .auth import simple_token
-from .storage import Store
+from .storage import Store, Log
+from .utils import cached
+from . import rollups, client
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 views = Blueprint("grafana", __name__)
 
+# results of identical queries (after rounding the range) are reused this long
+QUERY_CACHE_SECONDS = 10
+# what downsample() can do with a bucket of points; anything else means "mean"
+AGGREGATIONS = ("mean", "min", "max", "last", "lttb")
+
+
+@cached(max_age=timedelta(seconds=30))
+async def fetch_json(url):
+    """GET url; concurrent requests for the same URL share one fetch."""
+    r = await client.get(url)
+    return r.json()
+
 
 def get_time_range(the_range):
     if not the_range:
         return None, None
 
     def parse_time(string):
-        return datetime.strptime(string, "%Y-%m-%dT%H:%M:%S.%fZ").astimezone(
-            timezone.utc
+        return datetime.strptime(string, "%Y-%m-%dT%H:%M:%S.%fZ").replace(
+            tzinfo=timezone.utc
         )
 
     return parse_time(the_range["from"]), parse_time(the_range["to"])
@@ -24,7 +44,7 @@ def get_time_range(the_range):
 
 def to_grafana_type(some_type):
     if isinstance(some_type, list):
-        some_type = type(some_type[0])
+        some_type = type(some_type[0]) if some_type else float
     return {
         int: "number",
         float: "number",
@@ -43,9 +63,19 @@ def to_grafana_value(some_value):
     abort(500)
 
 
-async def get_table(target):
-    if target == "schika":
-        async with Store("schika_ranks") as ranks:
+def parse_log_target(target):
+    """log:<metric>[:<stat>]; plain log metrics count rows, others are averaged."""
+    _, metric, *stat = target.split(":")
+    return metric, stat[0] if stat else ("mean" if "." in metric else "count")
+
+
+async def get_table(target, start=None, stop=None, interval=0, max_points=None):
+    if target.startswith("log:"):
+        metric, stat = parse_log_target(target)
+        points = await rollups.series(metric, stat, start, stop, interval, max_points)
+        return {"time": [moment for _, moment in points], stat: [value for value, _ in points]}
+    elif target == "schika":
+        async with Store.read("schika_ranks") as ranks:
             players = sorted(
                 ranks, key=lambda player: ranks[player]["score"], reverse=True
             )
@@ -53,9 +83,9 @@ async def get_table(target):
             scores = [ranks[player]["score"] for player in players]
             return {"player": players, "score": scores}
     elif target == "corona_vaccine":
-        r = await asks.get("https://disease.sh/v3/covid-19/vaccine")
+        data = await fetch_json("https://disease.sh/v3/covid-19/vaccine")
         phases, candidates = [], []
-        for phase in r.json()["phases"]:
+        for phase in data["phases"]:
             phases.append(phase["phase"])
             candidates.append(int(phase["candidates"]))
         return {"phases": phases, "candidates": candidates}
@@ -68,7 +98,84 @@ def stupid_date_to_normal(datestr):
     return datetime.strptime(datestr, "%m/%d/%y")
 
 
-async def get_timeseries(target):
+def downsample(points, max_points, interval=0, aggregation="mean"):
+    """Reduce [value, ms] points (in time order) to at most max_points.
+
+    Points are grouped into buckets at least interval ms wide and aggregated
+    with mean/min/max/last (the bucket's first timestamp is kept), or picked
+    by Largest-Triangle-Three-Buckets for aggregation="lttb".
+    """
+    if not max_points or len(points) <= max_points:
+        return points
+    if not all(isinstance(value, (int, float)) for value, _ in points):
+        return points
+    if aggregation == "lttb":
+        return lttb(points, max_points)
+    first, last = points[0][1], points[-1][1]
+    # + 1 so that the last point still falls into bucket max_points - 1
+    width = max(interval, (last - first + 1) / max_points)
+    if numpy is not None:
+        values = numpy.array([value for value, _ in points], dtype=float)
+        times = numpy.array([ms for _, ms in points], dtype=float)
+        buckets = ((times - first) // width).astype(int)
+        starts = numpy.flatnonzero(numpy.diff(buckets, prepend=-1))
+        ends = numpy.append(starts[1:], len(points))
+        aggregated = {
+            "mean": lambda: numpy.add.reduceat(values, starts) / (ends - starts),
+            "min": lambda: numpy.minimum.reduceat(values, starts),
+            "max": lambda: numpy.maximum.reduceat(values, starts),
+            "last": lambda: values[ends - 1],
+        }[aggregation]()
+        return [list(row) for row in zip(aggregated.tolist(), times[starts].tolist())]
+    aggregate = {
+        "mean": lambda values: sum(values) / len(values),
+        "min": min,
+        "max": max,
+        "last": lambda values: values[-1],
+    }[aggregation]
+    result = []
+    for _, bucket in groupby(points, key=lambda point: (point[1] - first) // width):
+        bucket = list(bucket)
+        result.append([aggregate([value for value, _ in bucket]), bucket[0][1]])
+    return result
+
+
+def lttb(points, max_points):
+    """Largest-Triangle-Three-Buckets: keep the points that shape the line."""
+    if max_points < 3:
+        return [points[0], points[-1]][:max_points]
+    result = [points[0]]
+    size = (len(points) - 2) / (max_points - 2)
+    for i in range(max_points - 2):
+        start, end = int(i * size) + 1, int((i + 1) * size) + 1
+        following = points[end : int((i + 2) * size) + 1] or [points[-1]]
+        avg_value = sum(value for value, _ in following) / len(following)
+        avg_ms = sum(ms for _, ms in following) / len(following)
+        prev_value, prev_ms = result[-1]
+        bucket = points[start:end]
+        if numpy is not None:
+            values = numpy.array([value for value, _ in bucket], dtype=float)
+            times = numpy.array([ms for _, ms in bucket], dtype=float)
+            areas = numpy.abs(
+                (prev_ms - avg_ms) * (values - prev_value)
+                - (prev_ms - times) * (avg_value - prev_value)
+            )
+            result.append(bucket[int(areas.argmax())])
+        else:
+            result.append(
+                max(
+                    bucket,
+                    key=lambda point: abs(
+                        (prev_ms - avg_ms) * (point[0] - prev_value)
+                        - (prev_ms - point[1]) * (avg_value - prev_value)
+                    ),
+                )
+            )
+    result.append(points[-1])
+    return result
+
+
+async def get_timeseries(target, start=None, stop=None, interval=0, max_points=None):
     # tuples of value, datetime
     now = datetime.now().astimezone(timezone.utc)
     if target == "languageday":
@@ -78,7 +185,7 @@ async def get_timeseries(target):
     elif target == "weather":
         weather_location = os.environ.get("WEATHER_LOCATION", "Stuttgart,BW,DE")
         weather_api_key = os.environ.get("WEATHER_API_KEY")
-        r = await asks.get(
+        data = await fetch_json(
             f"https://api.openweathermap.org/data/2.5/weather?q={weather_location}&appid={weather_api_key}&units=metric"
         )
         yield {
@@ -137,33 +244,65 @@ async def get_timeseries(target):
             802: "⛅",
             803: "☁️",
             804: "☁️",
-        }[r.json()["weather"][0]["id"]], now - timedelta(hours=3)
+        }[data["weather"][0]["id"]], now - timedelta(hours=3)
+    elif target.startswith("log:"):
+        metric, stat = parse_log_target(target)
+        for point in await rollups.series(metric, stat, start, stop, interval, max_points):
+            yield point
+    elif target.startswith("rows:"):
+        # rows:<log>.<field>: the field's values as logged, for short ranges
+        key, _, field = target[len("rows:") :].rpartition(".")
+        async for row in Log(key).between(start, stop):
+            value = row.get(field)
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                if moment := rollups.row_time(row):
+                    yield value, moment
     elif target.startswith("corona_"):
         stat = target.split("_")[-1]
-        r = await asks.get("https://disease.sh/v3/covid-19/historical/DEU")
-        data = r.json()
+        data = await fetch_json("https://disease.sh/v3/covid-19/historical/DEU")
         for day in sorted(data["timeline"][stat], key=stupid_date_to_normal):
-            yield data["timeline"][stat][day], stupid_date_to_normal(day)
+            moment = stupid_date_to_normal(day)
+            if start and moment.replace(tzinfo=timezone.utc) < start:
+                continue
+            if stop and moment.replace(tzinfo=timezone.utc) > stop:
+                break
+            yield data["timeline"][stat][day], moment
     else:
         raise RuntimeError(f"Unknown target {target}")
         abort(400)
 
 
 async def make_target(
-    *, target=None, type="timeseries", refId="A", data=None, datasource=None
+    *,
+    target=None,
+    type="timeseries",
+    refId="A",
+    data=None,
+    datasource=None,
+    start=None,
+    stop=None,
+    interval=0,
+    max_points=None,
 ):
     # return a single JSON object
     if type == "timeseries":
+        aggregation = (data or {}).get("aggregation", "mean")
+        datapoints = [
+            # tuples of data, timestamp in ms
+            [to_grafana_value(value) for value in row]
+            async for row in get_timeseries(target, start, stop, interval, max_points)
+        ]
         return {
             "target": target,
-            "datapoints": [
-                # tuples of data, timestamp in ms
-                [to_grafana_value(value) for value in row]
-                async for row in get_timeseries(target)
-            ],
+            "datapoints": downsample(
+                datapoints,
+                max_points,
+                interval * 1000,
+                aggregation if aggregation in AGGREGATIONS else "mean",
+            ),
         }
     elif type == "table":
-        data = await get_table(target)
+        data = await get_table(target, start, stop, interval, max_points)
         keys = list(data)
         return {
             "type": "table",
@@ -181,6 +320,24 @@ async def make_target(
     abort(400)
 
 
+def round_down(moment, seconds):
+    if moment is None:
+        return None
+    return datetime.fromtimestamp(moment.timestamp() // seconds * seconds, timezone.utc)
+
+
+@cached(max_age=timedelta(seconds=QUERY_CACHE_SECONDS), max_entries=1024)
+async def evaluate_target(target, start, stop, interval, max_points):
+    # target is normalized JSON, so the arguments can be the cache key
+    return await make_target(
+        **json.loads(target),
+        start=start,
+        stop=stop,
+        interval=interval,
+        max_points=max_points,
+    )
+
+
 @views.route("/")
 @simple_token("GRAFANA_TOKEN")
 async def grafana_index():
@@ -199,6 +356,7 @@ async def grafana_search():
             "corona_deaths",
             "corona_recovered",
             "corona_vaccine",
+            *(f"log:{metric}" for metric in await rollups.metric_names()),
         ]
     )
 
@@ -207,12 +365,26 @@ async def grafana_search():
 @simple_token("GRAFANA_TOKEN")
 async def grafana_query():
     data = json.loads((await request.get_data()).decode("utf-8"))
-    # ignoring these for now; FIXME
     start, stop = get_time_range(data.get("range"))
     interval = int(data.get("intervalMs", 0)) / 1000
+    max_points = data.get("maxDataPoints")
+    # ignoring these for now; FIXME
     filters = data.get("adhocFilters", [])
 
-    result = [await make_target(**target) for target in data["targets"]]
+    step = max(interval, QUERY_CACHE_SECONDS)
+    start = round_down(start, step)
+    if stop:
+        stop = round_down(stop, step) + timedelta(seconds=step)
+    result = [None] * len(data["targets"])
+
+    async def evaluate(i, target):
+        result[i] = await evaluate_target(
+            json.dumps(target, sort_keys=True), start, stop, interval, max_points
+        )
+
+    async with open_nursery() as nursery:
+        for i, target in enumerate(data["targets"]):
+            nursery.start_soon(evaluate, i, target)
     print(result)
     return jsonify(result)
 
@@ -1,6 +1,6 @@
 from quart import request, jsonify, Blueprint
-from .storage import Log, Store
-from .utils import elo, timestamp
+from .storage import Log, Store, version
+from .utils import elo, timestamp, etagged
 
 views = Blueprint("krank", __name__)
 
@@ -16,15 +16,17 @@ async def klog_html():
 
 
 @views.route("/table")
+@etagged(lambda: (version("kv", "krank"), version("kv", "krank_hidden")))
 async def ktable():
-    async with Store("krank") as ranks:
-        async with Store("krank_hidden") as hidden:
+    async with Store.read("krank") as ranks:
+        async with Store.read("krank_hidden") as hidden:
             return jsonify({k: v for (k, v) in ranks.items() if k not in hidden})
 
 
 @views.route("/log.json")
+@etagged(lambda: version("log", "krank"))
 async def klog(html=False, last=8):
-    entries = [entry async for entry in Log("krank")][-last:]
+    entries = await Log("krank").tail(last)
     if html:
         return "<br><br>".join(
             "".join(
@@ -1,11 +1,16 @@
 import re
+import random
+import logging
+from functools import partial
 from datetime import timedelta, datetime
 
 from quart import Blueprint, request
-import requests
+from trio import CapacityLimiter, open_nursery, to_thread, sleep
 import vvspy
 
-from .utils import cached
+from .utils import cached, etagged
+from .events import publish
+from . import client
 
 
 # TODO: https://stuttgarterbaeder.de/baeder/jsonData/baeder.json
@@ -19,6 +24,14 @@ STOPS = [
 
 CITY_DIRECTIONS = "Botnang", "Marienplatz", "Vaihingen", "Charlottenplatz", "Vogelsang"
 
+# vvspy is blocking, so it runs in threads; at most this many at once
+upstream = CapacityLimiter(4)
+
+
+async def fetch(fn, *args, **kwargs):
+    return await to_thread.run_sync(partial(fn, *args, **kwargs), limiter=upstream)
+
+
 def is_valid(v):
     return datetime.strptime(v["from"], "%Y-%m-%d") <= datetime.now() < datetime.strptime(v["to"], "%Y-%m-%d")
 
@@ -45,14 +58,14 @@ def is_open(p):
     return False
 
 
-@cached(max_age=timedelta(hours=2))
-def _get_pool_info():
-    return requests.get("https://stuttgarterbaeder.de/baeder/jsonData/baeder.json").json()
+@cached(max_age=timedelta(hours=2), stale_for=timedelta(hours=1))
+async def _get_pool_info():
+    r = await client.get("https://stuttgarterbaeder.de/baeder/jsonData/baeder.json")
+    return r.json()
 
 
-@views.route("/swimming-pool")
-async def get_swimming_pool():
-    pool_data = _get_pool_info()
+async def render_swimming_pool():
+    pool_data = await _get_pool_info()
     solebad = next(part for part in pool_data if part["name"] == "SoleBad Cannstatt")
     hours = [h for t in solebad["businesshours"].values() for h in t if is_valid(h["validity"])]
     parts = []
@@ -65,11 +78,12 @@ async def get_swimming_pool():
     </ul>"""
 
 
-@cached(max_age=timedelta(minutes=2))
-def _get_departures():
+@cached(max_age=timedelta(minutes=2), stale_for=timedelta(minutes=1))
+async def _get_departures():
     departures = []
-    for station, walking_minutes in STOPS:
-        for departure in vvspy.get_departures(station, limit=5):
+
+    async def get_stop(station, walking_minutes):
+        for departure in await fetch(vvspy.get_departures, station, limit=5):
             direction = departure.serving_line.direction
             departures.append(
                 {
@@ -81,13 +95,17 @@ def _get_departures():
                     "walking_minutes": walking_minutes,
                 }
             )
+
+    async with open_nursery() as nursery:
+        for station, walking_minutes in STOPS:
+            nursery.start_soon(get_stop, station, walking_minutes)
     departures.sort(key=lambda d: d["datetime"])
     return departures
 
 
-@cached(max_age=timedelta(hours=2))
-def _get_biergarten_event():
-    r = requests.get("https://www.augustiner-biergarten-stuttgart.de/home/")
+@cached(max_age=timedelta(hours=2), stale_for=timedelta(hours=1))
+async def _get_biergarten_event():
+    r = await client.get("https://www.augustiner-biergarten-stuttgart.de/home/")
     events = re.findall(r'schema.org/Event.*?itemprop="startDate" content="([^"]+)".*?feed_title" itemprop="name">([^<]+)', r.text)
     today = datetime.today().date()
     for date, title in events:
@@ -96,10 +114,9 @@ def _get_biergarten_event():
             return title, start
 
 
-@views.route("/departures")
-async def get_departures():
+async def render_departures():
     now = datetime.now()
-    departures = _get_departures()
+    departures = await _get_departures()
     result = []
     for departure in departures:
         if len(result) >= 3 and departure["datetime"] > (now + timedelta(minutes=20)):
@@ -128,9 +145,8 @@ async def get_departures():
     </ul>"""
 
 
-@views.route("/biergarten")
-async def get_biergarten_events():
-    if event := _get_biergarten_event():
+async def render_biergarten():
+    if event := await _get_biergarten_event():
         title, time = event
         message = f"Heute ab {time:%H:%M}: {title}"
     else:
@@ -140,6 +156,81 @@ async def get_biergarten_events():
     """
 
 
+# fragment name -> (render function, seconds between refreshes)
+FRAGMENTS = {
+    "departures": (render_departures, 20),
+    "swimming-pool": (render_swimming_pool, 300),
+    "biergarten": (render_biergarten, 1800),
+}
+fragments = {}  # fragment name -> (last good html, when it was rendered)
+
+
+async def keep_fresh(name):
+    render, interval = FRAGMENTS[name]
+    failures = 0
+    while True:
+        try:
+            html = await render()
+            if fragments.get(name, (None,))[0] != html:
+                publish(f"mls7-{name}")
+            fragments[name] = html, datetime.now()
+            failures = 0
+            delay = interval
+        except Exception:
+            logging.exception("Refreshing %s failed", name)
+            failures += 1
+            delay = min(interval, 2 ** failures) * random.uniform(0.5, 1.5)
+        await sleep(delay)
+
+
+async def refresh_dashboard():
+    """Keep the dashboard's fragments rendered, so requests only serve memory."""
+    async with open_nursery() as nursery:
+        for name in FRAGMENTS:
+            nursery.start_soon(keep_fresh, name)
+
+
+def stale_since(name):
+    """When the fragment was rendered, if that's too long ago."""
+    _, interval = FRAGMENTS[name]
+    _, rendered_at = fragments[name]
+    if datetime.now() - rendered_at > timedelta(seconds=2 * interval):
+        return rendered_at
+
+
+def fragment_tag(name):
+    if name in fragments:
+        return fragments[name][0], stale_since(name)
+
+
+async def serve_fragment(name):
+    render, _ = FRAGMENTS[name]
+    if name not in fragments:  # not rendered yet, or the refresher isn't running
+        fragments[name] = await render(), datetime.now()
+    html, _ = fragments[name]
+    if rendered_at := stale_since(name):
+        html += f"<small class='stale'>Stand {rendered_at:%H:%M}</small>"
+    return html
+
+
+@views.route("/departures")
+@etagged(lambda: fragment_tag("departures"))
+async def get_departures():
+    return await serve_fragment("departures")
+
+
+@views.route("/swimming-pool")
+@etagged(lambda: fragment_tag("swimming-pool"))
+async def get_swimming_pool():
+    return await serve_fragment("swimming-pool")
+
+
+@views.route("/biergarten")
+@etagged(lambda: fragment_tag("biergarten"))
+async def get_biergarten_events():
+    return await serve_fragment("biergarten")
+
+
 @views.route("/")
 async def index():
     return """<!DOCTYPE html>
@@ -149,6 +240,7 @@ async def index():
         <meta name="viewport" content="width=device-width, initial-scale=1.0">
         <title>MLS7</title>
         <script src="https://unpkg.com/htmx.org@1.9.2"></script>
+        <script src="https://unpkg.com/htmx.org@1.9.2/dist/ext/sse.js"></script>
         <style>
             #cards {
                 max-width: 1080px;
@@ -188,15 +280,19 @@ async def index():
             .open-yes {
                 color: forestgreen;
             }
+            .stale {
+                color: gray;
+            }
         </style>
     </head>
     <body>
-        <div id="cards">
-            <div class="card" hx-get="/mls7/departures" hx-trigger="load every 30s">
+        <div id="cards" hx-ext="sse" sse-connect="/events?topics=mls7-departures,mls7-biergarten,mls7-swimming-pool">
+            <!-- the slow polls only catch the "Stand" marker of fragments that stopped updating -->
+            <div class="card" hx-get="/mls7/departures" hx-trigger="load, sse:mls7-departures, every 300s">
             </div>
-            <div class="card" hx-get="/mls7/biergarten" hx-trigger="load">
+            <div class="card" hx-get="/mls7/biergarten" hx-trigger="load, sse:mls7-biergarten">
             </div>
-            <div class="card" hx-get="/mls7/swimming-pool" hx-trigger="load every 900s">
+            <div class="card" hx-get="/mls7/swimming-pool" hx-trigger="load, sse:mls7-swimming-pool, every 900s">
             </div>
         </div>
     </body>
@@ -0,0 +1,181 @@
+"""Ratings rebuilt by replaying the match history of a league's log.
+
+Try other rules with e.g. apy4i-ratings krank --k 16 24 (or GET /ratings/krank?k=16&k=24).
+"""
+import argparse
+
+from quart import Blueprint, request, abort, jsonify
+from trio import run
+from .storage import Store, Log, version
+from .utils import elo, etagged
+from .slack_commands import sim_indicators
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+views = Blueprint("ratings", __name__)
+
+# league -> how its store looks and the rules it was played with
+LEAGUES = {
+    # ranks: player -> score; the change is rounded before it's applied
+    "krank": {"store": "krank", "k": 16, "start": 1000, "rounding": "delta"},
+    # ranks: player -> {"score", "active"}; the new score is rounded
+    "schika": {"store": "schika_ranks", "k": 16, "start": 1000, "rounding": "score"},
+}
+SCORES = {"a": (1, 0), "b": (0, 1), "draw": (0.5, 0.5)}
+
+
+async def history(league):
+    """The league's log as ("match", team_a, team_b, outcome) and ("set", player, score)."""
+    events = []
+    async for row in Log(league):
+        if league == "krank":
+            if "winners" in row:
+                events.append(("match", list(row["winners"]), list(row["losers"]), "a"))
+        elif "participants" in row:
+            if any(token in sim_indicators for token in row["raw_text"].lower().split()):
+                continue
+            a, b = row["participants"]
+            outcome = {a: "a", b: "b", None: "draw"}[row["winner"]]
+            events.append(("match", [a], [b], outcome))
+        else:
+            for player, (_, score) in row["change"].items():
+                events.append(("set", player, score))
+    return events
+
+
+def replay_one(events, k, start, rounding):
+    ratings = {}
+    for event in events:
+        if event[0] == "set":
+            _, player, score = event
+            ratings[player] = score
+            continue
+        _, team_a, team_b, outcome = event
+        scores_a = [ratings.setdefault(player, start) for player in team_a]
+        scores_b = [ratings.setdefault(player, start) for player in team_b]
+        delta_a, delta_b = elo(
+            scores_a, scores_b, outcome, k=k, rounding=rounding == "delta"
+        )
+        for team, delta in (team_a, delta_a), (team_b, delta_b):
+            for player in team:
+                ratings[player] += delta
+                if rounding == "score":
+                    ratings[player] = round(ratings[player])
+    return ratings
+
+
+def replay(events, variants, rounding):
+    """The ratings after the events, for each (k, start) variant of the rules.
+
+    Several variants are replayed together with NumPy: every match updates
+    the ratings of all of them at once.
+    """
+    if numpy is None or len(variants) == 1:
+        return [replay_one(events, k, start, rounding) for k, start in variants]
+    index = {}
+    for event in events:
+        for player in [event[1]] if event[0] == "set" else event[1] + event[2]:
+            index.setdefault(player, len(index))
+    k = numpy.array([k for k, _ in variants], dtype=float)
+    ratings = numpy.array([[start] * len(index) for _, start in variants], dtype=float)
+    for event in events:
+        if event[0] == "set":
+            _, player, score = event
+            ratings[:, index[player]] = score
+            continue
+        _, team_a, team_b, outcome = event
+        team_a = [index[player] for player in team_a]
+        team_b = [index[player] for player in team_b]
+        q_a = 10 ** (ratings[:, team_a].mean(axis=1) / 400)
+        q_b = 10 ** (ratings[:, team_b].mean(axis=1) / 400)
+        s_a, s_b = SCORES[outcome]
+        delta_a = k * (s_a - q_a / (q_a + q_b))
+        delta_b = k * (s_b - q_b / (q_a + q_b))
+        if rounding == "delta":
+            delta_a, delta_b = numpy.round(delta_a), numpy.round(delta_b)
+        ratings[:, team_a] += delta_a[:, None]
+        ratings[:, team_b] += delta_b[:, None]
+        if rounding == "score":
+            ratings[:, team_a] = numpy.round(ratings[:, team_a])
+            ratings[:, team_b] = numpy.round(ratings[:, team_b])
+    return [
+        {player: ratings[v, i].item() for player, i in index.items()}
+        for v in range(len(variants))
+    ]
+
+
+async def stored(league):
+    async with Store.read(LEAGUES[league]["store"]) as ranks:
+        if league == "schika":
+            return {player: rank["score"] for player, rank in ranks.items()}
+        return dict(ranks)
+
+
+async def report(league, ks=(), starts=()):
+    """Replayed ratings for every combination of K-factor and starting rating.
+
+    Also lists where they differ from the store, which for the league's own
+    rules means the store and the log disagree.
+    """
+    rules = LEAGUES[league]
+    variants = [(k, start) for k in ks or [rules["k"]] for start in starts or [rules["start"]]]
+    events = await history(league)
+    current = await stored(league)
+    return {
+        "matches": sum(1 for event in events if event[0] == "match"),
+        "variants": [
+            {
+                "k": k,
+                "start": start,
+                "ratings": ratings,
+                "differences": {
+                    player: [current.get(player), rating]
+                    for player, rating in ratings.items()
+                    if current.get(player) != rating
+                },
+            }
+            for (k, start), ratings in zip(variants, replay(events, variants, rules["rounding"]))
+        ],
+    }
+
+
+def replay_tag():
+    league = request.view_args["league"]
+    if league in LEAGUES:
+        store = LEAGUES[league]["store"]
+        return version("log", league), version("kv", store), request.query_string
+
+
+@views.route("/<league>")
+@etagged(replay_tag)
+async def replayed(league):
+    if league not in LEAGUES:
+        abort(404)
+    ks = [float(k) for k in request.args.getlist("k")]
+    starts = [float(start) for start in request.args.getlist("start")]
+    return jsonify(await report(league, ks, starts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("league", choices=LEAGUES)
+    parser.add_argument("--k", type=float, nargs="+", default=())
+    parser.add_argument("--start", type=float, nargs="+", default=())
+    args = parser.parse_args()
+    result = run(report, args.league, args.k, args.start)
+    print(f"{result['matches']} matches")
+    for variant in result["variants"]:
+        print(f"\nk={variant['k']:g} start={variant['start']:g}")
+        ranking = sorted(variant["ratings"].items(), key=lambda item: -item[1])
+        for player, rating in ranking:
+            note = ""
+            if player in variant["differences"]:
+                note = f"  (stored: {variant['differences'][player][0]})"
+            print(f"  {player:<20} {rating:>8.1f}{note}")
+
+
+if __name__ == "__main__":
+    main()
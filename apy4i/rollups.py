@@ -0,0 +1,181 @@
+import os
+import re
+import logging
+from datetime import datetime, timezone, timedelta
+from trio import sleep, to_thread
+from .storage import Store, Log, LOGS_PATH, log_listeners
+
+# name -> (seconds per bucket, format of the group of buckets stored together)
+RESOLUTIONS = {
+    "minute": (60, "%Y-%m-%d"),
+    "hour": (3600, "%Y-%m"),
+    "day": (86400, "%Y"),
+}
+STATS = {
+    "count": lambda count, total, low, high: count,
+    "sum": lambda count, total, low, high: total,
+    "min": lambda count, total, low, high: low,
+    "max": lambda count, total, low, high: high,
+    "mean": lambda count, total, low, high: total / count,
+}
+# how long buckets are kept, per resolution (the others are kept forever)
+RETENTION = {"minute": timedelta(days=int(os.environ.get("ROLLUP_MINUTE_DAYS", 14)))}
+PRUNE_INTERVAL = 3600
+NOT_A_LOG = re.compile(r"\.(segments|tmp|lock|\d+(\.gz|\.xz)?)$")
+
+
+def metrics(key, row):
+    """The (metric, value) pairs a log row counts towards."""
+    yield key, 1
+    for field, value in row.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f"{key}.{field}", value
+    # ratings after a game, as logged by krank (winners/losers) and schika (change)
+    for field in ("winners", "losers", "change"):
+        if isinstance(row.get(field), dict):
+            for player, change in row[field].items():
+                if isinstance(change, list) and isinstance(change[-1], (int, float)):
+                    yield f"{key}.{player}", change[-1]
+
+
+def row_time(row):
+    try:
+        return datetime.strptime(row["ts"], "%Y-%m-%dT%H:%M:%S.%f%z")
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def fold(rollups, key, row, moment):
+    """Count a row into the (count, sum, min, max) of its buckets."""
+    moment = moment.astimezone(timezone.utc)
+    for metric, value in metrics(key, row):
+        for resolution, (seconds, group_format) in RESOLUTIONS.items():
+            group = f"{metric}|{resolution}|{moment:{group_format}}"
+            bucket = str(int(moment.timestamp() // seconds * seconds))
+            buckets = rollups.setdefault(group, {})
+            if bucket in buckets:
+                count, total, low, high = buckets[bucket]
+                buckets[bucket] = [count + 1, total + value, min(low, value), max(high, value)]
+            else:
+                buckets[bucket] = [1, value, value, value]
+
+
+async def on_log(key, rows, position):
+    rows = [row for row in rows if isinstance(row, dict)]
+    async with Store("rollups") as rollups:
+        # rows before the position the log was first folded from are left to
+        # backfill_rollups (also those of batches that got here late)
+        logs = rollups.setdefault("_logs", {})
+        state = logs.setdefault(key, {"live_from": position, "backfilled": False})
+        if position < state["live_from"]:
+            return
+        for row in rows:
+            fold(rollups, key, row, row_time(row) or datetime.now(timezone.utc))
+
+
+log_listeners.append(on_log)
+
+
+async def backfill_rollups():
+    """Fold in the rows logs had before their rollups were kept up to date."""
+    names = await to_thread.run_sync(os.listdir, LOGS_PATH)
+    for key in sorted({NOT_A_LOG.sub("", name) for name in names}):
+        try:
+            await backfill(key)
+        except Exception:
+            logging.exception("Backfilling the rollups of %s failed", key)
+
+
+async def backfill(key):
+    end = await Log(key).end()  # later batches are folded live
+    async with Store("rollups") as rollups:
+        logs = rollups.setdefault("_logs", {})
+        state = logs.setdefault(key, {"live_from": end, "backfilled": False})
+        if state["backfilled"]:
+            return
+        live_from = state["live_from"]
+    partial = {}
+    async for row in Log(key).before(live_from):
+        if isinstance(row, dict) and (moment := row_time(row)):
+            fold(partial, key, row, moment)
+    async with Store("rollups") as rollups:
+        if rollups["_logs"][key]["backfilled"]:
+            return  # another process was faster
+        for group, buckets in partial.items():
+            merged = rollups.setdefault(group, {})
+            for bucket, (count, total, low, high) in buckets.items():
+                if bucket in merged:
+                    c, t, l, h = merged[bucket]
+                    merged[bucket] = [c + count, t + total, min(l, low), max(h, high)]
+                else:
+                    merged[bucket] = [count, total, low, high]
+        rollups["_logs"][key]["backfilled"] = True
+
+
+async def prune_rollups():
+    """Drop the groups of buckets that are older than their resolution is kept."""
+    now = datetime.now(timezone.utc)
+    async with Store("rollups") as rollups:
+        for group in [group for group in rollups if group != "_logs"]:
+            _, resolution, period = group.rsplit("|", 2)
+            if resolution in RETENTION:
+                _, group_format = RESOLUTIONS[resolution]
+                day = datetime.strptime(period, group_format).replace(tzinfo=timezone.utc)
+                if day + timedelta(days=1) < now - RETENTION[resolution]:
+                    del rollups[group]
+
+
+async def prune_rollups_periodically():
+    while True:
+        try:
+            await prune_rollups()
+        except Exception:
+            logging.exception("Pruning rollups failed")
+        await sleep(PRUNE_INTERVAL)
+
+
+async def metric_names():
+    async with Store.read("rollups") as rollups:
+        return sorted({group.partition("|")[0] for group in rollups if group != "_logs"})
+
+
+def pick_resolution(start, stop, interval=0, max_points=None):
+    """The finest resolution that isn't finer than the interval or the panel.
+
+    Resolutions that aren't kept back to the start of the range are skipped.
+    """
+    span = (stop - start).total_seconds() if start and stop else 0
+    now = datetime.now(timezone.utc)
+    for resolution, (seconds, _) in RESOLUTIONS.items():
+        if resolution in RETENTION and (not start or start < now - RETENTION[resolution]):
+            continue
+        if seconds >= interval and (not max_points or span / seconds <= max_points):
+            return resolution
+    return "day"
+
+
+async def series(metric, stat, start=None, stop=None, interval=0, max_points=None):
+    """(value, datetime) per bucket of metric between start and stop.
+
+    Only the groups covering the range are looked at.
+    """
+    resolution = pick_resolution(start, stop, interval, max_points)
+    seconds, group_format = RESOLUTIONS[resolution]
+    prefix = f"{metric}|{resolution}|"
+    async with Store.read("rollups") as rollups:
+        if start and stop:
+            groups, day = [], start
+            while day < stop + timedelta(days=1):
+                if (group := f"{prefix}{day:{group_format}}") not in groups:
+                    groups.append(group)
+                day += timedelta(days=1)
+        else:
+            groups = sorted(group for group in rollups if group.startswith(prefix))
+        points = []
+        for group in groups:
+            for bucket, values in rollups.get(group, {}).items():
+                moment = datetime.fromtimestamp(int(bucket), timezone.utc)
+                if (not start or moment >= start) and (not stop or moment < stop):
+                    points.append((STATS[stat](*values), moment))
+    points.sort(key=lambda point: point[1])
+    return points
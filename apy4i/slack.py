@@ -1,13 +1,54 @@
+import os
+import logging
 import contextvars
 from urllib.parse import parse_qs
-import asks
-from quart import request, jsonify
+from quart import request, jsonify, current_app
+from trio import TASK_STATUS_IGNORED, CapacityLimiter, move_on_after, open_nursery, sleep_forever
+from werkzeug.exceptions import HTTPException
 from .storage import Log
 from .auth import signing_secret
+from . import client
 
 
 rq_data = contextvars.ContextVar("rq_data")
 
+# commands run after Slack got its answer, so they aren't bound by its 3s limit
+COMMAND_TIMEOUT = float(os.environ.get("SLACK_COMMAND_TIMEOUT", 60))
+COMMAND_LIMITS = {"eval": 2}  # concurrent runs per command
+DEFAULT_COMMAND_LIMIT = 4
+command_nursery = None
+limiters = {}
+
+
+async def run_commands(task_status=TASK_STATUS_IGNORED):
+    global command_nursery
+    async with open_nursery() as command_nursery:
+        task_status.started()
+        await sleep_forever()
+
+
+async def run_command(app, data, command, handler, rest):
+    rq_data.set(data)
+    if command not in limiters:
+        limiters[command] = CapacityLimiter(COMMAND_LIMITS.get(command, DEFAULT_COMMAND_LIMIT))
+    async with app.app_context():
+        try:
+            async with Log("requests") as l:
+                await l.log(data)
+            with move_on_after(COMMAND_TIMEOUT) as timeout:
+                async with limiters[command]:
+                    result = await handler(data["user_name"], rest)
+            if timeout.cancelled_caught:
+                await ephemeral(f"{command} timed out.")
+                return
+            response = await app.make_response(result)
+            if response.is_json:
+                await respond(await response.get_json())
+        except HTTPException as e:
+            await ephemeral(e.description)
+        except Exception:
+            logging.exception("Slack command %s failed", command)
+
 
 @signing_secret("SLACK_SIGNING_SECRET")
 async def slack():
@@ -15,17 +56,18 @@ async def slack():
 
     data = await request.get_data()
     data = {k: v[0] for (k, v) in parse_qs(data.decode("utf-8")).items()}
+    command, _, rest = data["text"].partition(" ")
+    handler = getattr(slack_commands, command, slack_commands.default_command)
+    if command_nursery is not None and handler is not slack_commands.default_command:
+        command_nursery.start_soon(
+            run_command, current_app._get_current_object(), data, command, handler, rest
+        )
+        return "", 200
+
     rq_data.set(data)
     async with Log("requests") as l:
         await l.log(data)
-    user = data["user_name"]
-    text = data["text"]
-
-    command, _, rest = text.partition(" ")
-
-    return await getattr(slack_commands, command, slack_commands.default_command)(
-        user, rest
-    )
+    return await handler(data["user_name"], rest)
 
 
 async def in_channel(text, hide_sender=False):
@@ -51,5 +93,5 @@ async def attachment(hide_sender=False, public=True, **kwargs):
 
 
 async def respond(data):
-    await asks.post(rq_data.get()["response_url"], json=data)
+    await client.post(rq_data.get()["response_url"], json=data)
     return "No content", 204
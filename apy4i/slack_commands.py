@@ -1,9 +1,9 @@
-import asks
 from quart import abort
 from textflip import flip as flop
 from .slack import in_channel, ephemeral, attachment
 from .storage import Store, Log
 from .utils import elo, timestamp
+from . import client
 
 win_indicators = [
     "gewinnt",
@@ -43,7 +43,7 @@ async def help(user, text):
 
 
 async def eval(user, text):
-    r = await asks.post("http://localhost:8060/eval", json={"input": text.strip().strip("`")})
+    r = await client.post("http://localhost:8060/eval", json={"input": text.strip().strip("`")})
     if r.status_code != 200:
         return await in_channel("Failed to execute")
     r = r.json()
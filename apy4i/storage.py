@@ -1,38 +1,1098 @@
+import os
+import gzip
+import fcntl
+import copy
 import json
+import lzma
+import time
 import uuid
 import pickle
-from trio import Semaphore, Path
+import shutil
+import hashlib
+import logging
+import sqlite3
+from datetime import datetime
+from contextlib import contextmanager, suppress
+from collections.abc import MutableMapping
+from trio import (
+    Semaphore,
+    Path,
+    Event,
+    EndOfChannel,
+    sleep,
+    sleep_forever,
+    to_thread,
+    move_on_after,
+    open_nursery,
+    open_memory_channel,
+    wrap_file,
+    TASK_STATUS_IGNORED,
+)
+from .utils import timestamp, LRU
 
 locks = {"kv": {}, "log": {}}
+# key -> number of changes committed since startup, for ETags and the like
+versions = {"kv": {}, "log": {}}
+change_listeners = []  # functions called with (kind, key) whenever a version is bumped
+# (kind, key) -> disk_stamp() (or version of a SQLite store) when its version
+# was last bumped, to notice changes other processes made
+seen = {}
+
+
+def version(kind, key):
+    return versions[kind].get(key, 0)
+
+
+def bump(kind, key):
+    versions[kind][key] = version(kind, key) + 1
+    if kind == "kv" and STORE_BACKEND == "sqlite":
+        if key in sqlite_cache:
+            seen[kind, key] = sqlite_cache[key][0]
+    elif STORE_SHARED:
+        seen[kind, key] = disk_stamp(kind, key)
+    for listener in change_listeners:
+        listener(kind, key)
+
 
 STORE_PATH = Path("store")
 LOGS_PATH = Path("logs")
 BLOB_PATH = Path("blobs")
+BLOB_MAGIC = b"#blob:"
+# decoded blobs are kept around up to about this many (encoded) bytes
+BLOB_CACHE_BYTES = int(os.environ.get("BLOB_CACHE_BYTES", 32 * 1024 * 1024))
+blob_cache = LRU(BLOB_CACHE_BYTES)
+
+# seconds between write-backs of dirty stores
+FLUSH_INTERVAL = float(os.environ.get("STORE_FLUSH_INTERVAL", 5))
+# once this many (approximate) bytes are waiting, stores are written through
+MAX_DIRTY_BYTES = int(os.environ.get("STORE_MAX_DIRTY_BYTES", 1024 * 1024))
+
+cache = {}  # key -> decoded data, shared by all Store(key) blocks
+dirty = {}  # key -> approximate encoded size of unflushed data
+written = {}  # key -> (size, hash) of what is currently on disk
+
+# stores that append key-level changes to a journal instead of being rewritten
+JOURNALED = set(
+    filter(None, os.environ.get("STORE_JOURNALED", "alerts,foodsched,rollups").split(","))
+)
+# journals are folded into the snapshot once they're bigger than this (or the snapshot)
+JOURNAL_COMPACT_BYTES = int(os.environ.get("STORE_JOURNAL_COMPACT_BYTES", 256 * 1024))
+journal_sizes = {}  # key -> bytes in the journal file
+
+# "json" (files under STORE_PATH) or "sqlite" (one WAL-mode database, safe to
+# share between worker processes; changes are noticed by polling its versions)
+STORE_BACKEND = os.environ.get("STORE_BACKEND", "json")
+SQLITE_PATH = Path(os.environ.get("STORE_SQLITE_PATH", "store.sqlite3"))
+sqlite_connections = []  # idle connections to SQLITE_PATH
+# "yes" when several worker processes share STORE_PATH and LOGS_PATH: stores and
+# logs are then also locked with flock(2), stores are written through instead
+# of cached dirty, and cached data is reloaded once another process changed it
+STORE_SHARED = os.environ.get("STORE_SHARED", "no") == "yes"
+# seconds between checks for keys other processes changed, to bump their versions
+SHARED_POLL_INTERVAL = float(os.environ.get("STORE_SHARED_POLL_INTERVAL", 1))
+stamps = {}  # key -> disk_stamp() when the cached data was last known to match disk
+MISSING = object()
+
+
+class TrackedDict(dict):
+    """A dict that remembers which of its keys may have changed.
+
+    While tracking (i.e. inside a writing block), looking up a value that can
+    be modified in place counts as changing it. With an undo record, the old
+    value of every key is kept the first time it changes, for rollback().
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tracking = False
+        self.changed = set()  # since the last flush
+        self.touched = set()  # in the current writing block
+        self.undo = None
+
+    def _changing(self, key):
+        self.changed.add(key)
+        self.touched.add(key)
+        if self.undo is not None and key not in self.undo:
+            value = super().get(key, MISSING)
+            self.undo[key] = value if value is MISSING else copy.deepcopy(value)
+
+    def _looked_up(self, key, value):
+        if self.tracking and isinstance(value, (dict, list)):
+            self._changing(key)
+        return value
+
+    def __getitem__(self, key):
+        return self._looked_up(key, super().__getitem__(key))
+
+    def get(self, key, default=None):
+        return self._looked_up(key, super().get(key, default))
+
+    def items(self):
+        for key, value in super().items():
+            yield key, self._looked_up(key, value)
+
+    def values(self):
+        for _, value in self.items():
+            yield value
+
+    def __setitem__(self, key, value):
+        self._changing(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._changing(key)
+        super().__delitem__(key)
+
+    def setdefault(self, key, default=None):
+        self._changing(key)
+        return super().setdefault(key, default)
+
+    def pop(self, key, *default):
+        self._changing(key)
+        return super().pop(key, *default)
+
+    def popitem(self):
+        if not self:
+            raise KeyError("popitem(): dictionary is empty")
+        key = next(reversed(self.keys()))
+        return key, self.pop(key)
+
+    def update(self, *args, **kwargs):
+        other = dict(*args, **kwargs)
+        for key in other:
+            self._changing(key)
+        super().update(other)
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        for key in list(self.keys()):
+            self._changing(key)
+        super().clear()
+
+    def begin(self, undo):
+        """Start tracking a writing block, keeping an undo record if asked to."""
+        self.tracking = True
+        self.touched = set()
+        self.undo = {} if undo else None
+
+    def rollback(self):
+        """Restore the keys the current writing block changed."""
+        for key, value in self.undo.items():
+            if value is MISSING:
+                super().pop(key, None)
+            else:
+                super().__setitem__(key, value)
+        self.undo = None
+
+
+class RWLock:
+    """Shared for readers, exclusive for writers.
+
+    Everyone passes through a turnstile in arrival order, so a waiting writer
+    holds back readers that came after it instead of being starved by them.
+    With a path, whoever holds the room also holds a flock(2) of that file of
+    the same kind, which keeps other processes out.
+    """
+
+    def __init__(self, path=None):
+        self.turnstile = Semaphore(1)
+        self.room = Semaphore(1)  # held by one writer, or by all readers
+        self.readers = 0
+        self.path = path
+        self.fd = None
+
+    async def acquire_read(self):
+        async with self.turnstile:
+            if not self.readers:
+                await self.room.acquire()
+                await self.lock_file(fcntl.LOCK_SH)
+            self.readers += 1
+
+    def release_read(self):
+        self.readers -= 1
+        if not self.readers:
+            self.unlock_file()
+            self.room.release()
+
+    async def acquire_write(self):
+        async with self.turnstile:
+            await self.room.acquire()
+            await self.lock_file(fcntl.LOCK_EX)
+
+    def release_write(self):
+        self.unlock_file()
+        self.room.release()
+
+    async def lock_file(self, operation):
+        if self.path is None:
+            return
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            await to_thread.run_sync(fcntl.flock, fd, operation)
+        except BaseException:
+            os.close(fd)
+            self.room.release()
+            raise
+        self.fd = fd
+
+    def unlock_file(self):
+        if self.fd is not None:
+            os.close(self.fd)  # which releases the flock
+            self.fd = None
+
+
+@contextmanager
+def file_lock(path, operation):
+    """flock(2) the file (created if need be) while in the block, if STORE_SHARED."""
+    if not STORE_SHARED:
+        yield
+        return
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, operation)
+        yield
+    finally:
+        os.close(fd)
+
+
+def disk_stamp(kind, key):
+    """Identifies the current state of a store's or log's files on disk."""
+    if kind == "kv":
+        paths = STORE_PATH / key, STORE_PATH / f"{key}.journal"
+    else:
+        paths = LOGS_PATH / key, LOGS_PATH / f"{key}.segments"
+    stamp = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            stamp.append(None)
+        else:
+            stamp.append((st.st_ino, st.st_size, st.st_mtime_ns))
+    return tuple(stamp)
+
+
+class SQLiteMapping(MutableMapping):
+    """Dict-like view of one store's rows in the SQLite database.
+
+    The rows are the process's decoded copy of the store (see sqlite_cache),
+    which is brought up to date in a worker thread when the block starts, by
+    fetching only the rows that changed since. Only rows that were assigned,
+    deleted, or looked up as a mutable value in a writing block are written
+    back on commit.
+    """
+
+    def __init__(self, connection, name, readonly, rows, version):
+        self.connection = connection
+        self.name = name
+        self.readonly = readonly
+        self.rows = rows
+        self.version = version
+        self.changed = set()
+
+    def __getitem__(self, key):
+        value = self.rows[key]
+        if not self.readonly and isinstance(value, (dict, list)):
+            self.changed.add(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self.rows[key] = value
+        self.changed.add(key)
+
+    def __delitem__(self, key):
+        del self.rows[key]
+        self.changed.add(key)
+
+    def __contains__(self, key):
+        return key in self.rows
+
+    def __iter__(self):
+        return iter(list(self.rows))
+
+    def __len__(self):
+        return len(self.rows)
+
+    def commit(self):
+        """Write the changed rows (deleted ones as NULL) under the store's next version."""
+        if self.changed:
+            self.connection.execute(
+                "INSERT INTO versions (name, version) VALUES (?, 1) "
+                "ON CONFLICT (name) DO UPDATE SET version = version + 1",
+                (self.name,),
+            )
+            (self.version,) = self.connection.execute(
+                "SELECT version FROM versions WHERE name = ?", (self.name,)
+            ).fetchone()
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO store (name, key, value, version) VALUES (?, ?, ?, ?)",
+                [
+                    (self.name, key, json.dumps(self.rows[key]), self.version)
+                    if key in self.rows
+                    else (self.name, key, None, self.version)
+                    for key in self.changed
+                ],
+            )
+        self.connection.execute("COMMIT")
+
+
+# store -> [version, {key: decoded value}]: what this process knows of its rows
+sqlite_cache = {}
+
+
+def sqlite_connect():
+    connection = sqlite3.connect(
+        SQLITE_PATH, timeout=30, isolation_level=None, check_same_thread=False
+    )
+    connection.execute("PRAGMA journal_mode=WAL")
+    # every commit of a store bumps its version and stamps the rows it wrote
+    # with it; deleted rows stay behind as NULL, so others learn of them too
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS store (name TEXT, key TEXT, value TEXT, "
+        "version INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (name, key))"
+    )
+    try:
+        connection.execute("ALTER TABLE store ADD COLUMN version INTEGER NOT NULL DEFAULT 0")
+    except sqlite3.OperationalError:
+        pass  # created with it
+    connection.execute("CREATE INDEX IF NOT EXISTS store_changes ON store (name, version)")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, version INTEGER)"
+    )
+    return connection
+
+
+def fetch_rows(connection, name, since, readonly):
+    """Start a block's transaction and fetch what changed after version since.
+
+    Returns the store's version, the changed rows (MISSING if deleted), and
+    whether those are all rows (for since=None, or if the version went back).
+    Readers are done with the database after this, so their transaction ends.
+    """
+    # writers take the database's write lock right away, which also excludes
+    # writers in other processes
+    connection.execute("BEGIN" if readonly else "BEGIN IMMEDIATE")
+    row = connection.execute("SELECT version FROM versions WHERE name = ?", (name,)).fetchone()
+    version = row[0] if row else 0
+    full = since is None or since > version
+    if full:
+        query = "SELECT key, value FROM store WHERE name = ? AND value IS NOT NULL", (name,)
+    else:
+        query = "SELECT key, value FROM store WHERE name = ? AND version > ?", (name, since)
+    changes = {
+        key: MISSING if value is None else json.loads(value)
+        for key, value in ([] if since == version else connection.execute(*query))
+    }
+    if readonly:
+        connection.execute("ROLLBACK")
+    return version, changes, full
+
+
+def cached_rows(name, version, changes, full):
+    """Bring the cached rows of a store up to the fetched version."""
+    entry = sqlite_cache.get(name)
+    if entry is None or full and entry[0] != version:
+        entry = sqlite_cache[name] = [version, changes]
+    elif entry[0] < version:
+        # a concurrent reader may have applied some of them already
+        for key, value in changes.items():
+            if value is MISSING:
+                entry[1].pop(key, None)
+            else:
+                entry[1][key] = value
+        entry[0] = version
+    return entry
 
 
 class Store:
-    def __init__(self, key):
+    def __init__(self, key, readonly=False):
         self.key = key
         if key not in locks["kv"]:
-            locks["kv"][key] = Semaphore(1)
+            locks["kv"][key] = RWLock(STORE_PATH / f"{key}.lock" if STORE_SHARED else None)
         self.lock = locks["kv"][key]
+        self.readonly = readonly
         self.path = STORE_PATH / key
+        self.journal_path = STORE_PATH / f"{key}.journal"
         self.data = None
 
-    async def __aenter__(self):
-        await self.lock.acquire()
-        if await self.path.exists():
-            async with await self.path.open() as f:
-                self.data = json.loads(await f.read())
+    @classmethod
+    def read(cls, key):
+        """A block that only reads; the data must not be modified."""
+        return cls(key, readonly=True)
+
+    async def acquire(self):
+        if self.readonly:
+            await self.lock.acquire_read()
         else:
-            self.data = {}
+            await self.lock.acquire_write()
+
+    def release(self):
+        if self.readonly:
+            self.lock.release_read()
+        else:
+            self.lock.release_write()
+
+    async def __aenter__(self):
+        await self.acquire()
+        try:
+            if STORE_BACKEND == "sqlite":
+                self.data = await self.begin_sqlite()
+                return self.data
+            if STORE_SHARED:
+                await self.drop_if_changed()
+            if self.key not in cache:
+                # concurrent readers may both load; the first one to finish wins
+                data = await self.load()
+                cache.setdefault(self.key, data)
+            self.data = cache[self.key]
+        except BaseException:
+            self.release()
+            raise
+        if not self.readonly:
+            # unflushed changes of earlier blocks can't be reloaded from disk,
+            # so a failing block has to undo its own
+            self.data.begin(undo=self.key in dirty)
         return self.data
 
     async def __aexit__(self, exc_type, exc, tb):
+        try:
+            if isinstance(self.data, SQLiteMapping):
+                await self.end_sqlite(exc)
+                if exc is None and not self.readonly:
+                    bump("kv", self.key)
+                return
+            if self.readonly:
+                return
+            self.data.tracking = False
+            if exc is None:
+                self.data.undo = None
+                dirty[self.key] = self.pending_bytes()
+                if STORE_SHARED or sum(dirty.values()) > MAX_DIRTY_BYTES:
+                    await self.flush()
+                bump("kv", self.key)
+            elif self.data.undo is None:
+                # nothing unflushed: forget the partial changes, disk is the truth
+                cache.pop(self.key, None)
+            else:
+                self.data.rollback()
+        finally:
+            self.release()
+
+    async def begin_sqlite(self):
+        if sqlite_connections:
+            connection = sqlite_connections.pop()
+        else:
+            connection = await to_thread.run_sync(sqlite_connect)
+        entry = sqlite_cache.get(self.key)
+        try:
+            version, changes, full = await to_thread.run_sync(
+                fetch_rows, connection, self.key, entry and entry[0], self.readonly
+            )
+        except BaseException:
+            connection.close()
+            raise
+        if self.readonly:
+            sqlite_connections.append(connection)
+            connection = None
+        # readers share the cached rows; writers change them in place, which
+        # is fine as they have the store to themselves (also within the process)
+        version, rows = cached_rows(self.key, version, changes, full)
+        return SQLiteMapping(connection, self.key, self.readonly, rows, version)
+
+    async def end_sqlite(self, exc):
+        connection = self.data.connection
+        if connection is None:
+            return  # a reader
+        try:
+            if exc is None:
+                await to_thread.run_sync(self.data.commit)
+            else:
+                await to_thread.run_sync(connection.execute, "ROLLBACK")
+        except BaseException:
+            sqlite_cache.pop(self.key, None)
+            connection.close()
+            raise
         if exc is None:
-            async with await self.path.open("w") as f:
-                await f.write(json.dumps(self.data))
-        self.lock.release()
+            sqlite_cache[self.key][0] = self.data.version
+        else:
+            sqlite_cache.pop(self.key, None)  # may have been changed in place
+        sqlite_connections.append(connection)
+
+    def pending_bytes(self):
+        """About how many bytes flushing will write, including this block's changes."""
+        size = dirty.get(self.key, 0) + sum(
+            len(json.dumps(dict.get(self.data, key))) + len(key) for key in self.data.touched
+        )
+        if self.key in JOURNALED:
+            return size
+        return max(size, written.get(self.key, (0, None))[0])  # rewritten as a whole
+
+    async def load(self):
+        data = {}
+        if await self.path.exists():
+            async with await self.path.open() as f:
+                text = await f.read()
+            written[self.key] = len(text), hash(text)
+            data = json.loads(text)
+        data = TrackedDict(data)
+        if self.key in JOURNALED:
+            await self.replay_journal(data)
+        await self.stamp()
+        return data
+
+    async def stamp(self):
+        """Note that the cached data matches what's on disk now."""
+        if STORE_SHARED:
+            stamps[self.key] = await to_thread.run_sync(disk_stamp, "kv", self.key)
+
+    async def drop_if_changed(self):
+        """Forget the cached data if another process wrote the store since.
+
+        If that only appended to the journal, the new records are applied
+        instead. Caller must hold the lock.
+        """
+        if self.key not in cache:
+            return
+        old = stamps.get(self.key)
+        new = await to_thread.run_sync(disk_stamp, "kv", self.key)
+        if old == new:
+            return
+        snapshot, journal = old or (None, None)
+        if (
+            self.key in JOURNALED
+            and snapshot == new[0]
+            and journal
+            and new[1]
+            and journal[0] == new[1][0]  # same file
+            and journal[1] < new[1][1]  # that grew
+        ):
+            await self.replay_journal(cache[self.key], start=journal_sizes[self.key])
+            await self.stamp()
+        else:
+            cache.pop(self.key)
+
+    async def replay_journal(self, data, start=0):
+        """Apply the journal (from byte start on) on top of the snapshot.
+
+        A torn last record (the process died mid-append) is cut off.
+        """
+        if not await self.journal_path.exists():
+            journal_sizes[self.key] = 0
+            return
+        async with await self.journal_path.open("rb") as f:
+            await f.seek(start)
+            content = await f.read()
+        size = 0
+        for line in content.splitlines(keepends=True):
+            if not line.endswith(b"\n"):
+                break
+            try:
+                op, key, *value = json.loads(line)
+            except ValueError:
+                break
+            if op == "set":
+                dict.__setitem__(data, key, value[0])
+            else:
+                dict.pop(data, key, None)
+            size += len(line)
+        if size < len(content):
+            async with await self.journal_path.open("r+b") as f:
+                await f.truncate(start + size)
+        journal_sizes[self.key] = start + size
+
+    async def flush(self):
+        """Write the cached data back to disk. Caller must hold the lock (either kind).
+
+        The store stays dirty until the write succeeded.
+        """
+        if self.key not in dirty or self.key not in cache:
+            return
+        if self.key in JOURNALED:
+            await self.append_journal()
+        else:
+            await self.rewrite()
+        dirty.pop(self.key, None)
+
+    async def rewrite(self):
+        data = cache[self.key]
+        text = json.dumps(data)
+        if written.get(self.key) != (len(text), hash(text)):  # not if block(s) only read
+            # readers (also in other processes) see either the old or the new file
+            tmp_path = STORE_PATH / f"{self.key}.{uuid.uuid4().hex}.tmp"
+            async with await tmp_path.open("w") as f:
+                await f.write(text)
+            await tmp_path.replace(self.path)
+            written[self.key] = len(text), hash(text)
+            await self.stamp()
+        data.changed = set()
+
+    async def append_journal(self):
+        data = cache[self.key]
+        records = [
+            json.dumps(["set", key, dict.__getitem__(data, key)])
+            if key in data
+            else json.dumps(["del", key])
+            for key in data.changed
+        ]
+        if not records:
+            return
+        text = "".join(f"{record}\n" for record in records)
+        async with await self.journal_path.open("a") as f:
+            await f.write(text)
+        data.changed = set()
+        journal_sizes[self.key] = journal_sizes.get(self.key, 0) + len(text.encode())
+        await self.stamp()
+
+    async def compact(self):
+        """Fold the journal into a fresh snapshot. Caller must hold the lock.
+
+        The snapshot replaces the old one atomically before the journal is
+        emptied; dying in between only means the journal is replayed again.
+        """
+        await self.flush()
+        text = json.dumps(cache[self.key])
+        tmp_path = STORE_PATH / f"{self.key}.tmp"
+        async with await tmp_path.open("w") as f:
+            await f.write(text)
+            await f.flush()
+            await to_thread.run_sync(os.fsync, f.fileno())
+        await tmp_path.replace(self.path)
+        async with await self.journal_path.open("w"):
+            pass
+        written[self.key] = len(text), hash(text)
+        journal_sizes[self.key] = 0
+        await self.stamp()
+
+
+async def flush_stores():
+    for key in list(dirty):
+        store = Store.read(key)
+        await store.acquire()
+        try:
+            await store.flush()
+        finally:
+            store.release()
+
+
+async def compact_stores(force=False):
+    for key, size in list(journal_sizes.items()):
+        snapshot_size = written.get(key, (0, None))[0]
+        if not size or not force and size <= max(JOURNAL_COMPACT_BYTES, snapshot_size):
+            continue
+        # other processes may be reading the files without our read lock
+        store = Store(key) if STORE_SHARED else Store.read(key)
+        await store.acquire()
+        try:
+            if STORE_SHARED:
+                await store.drop_if_changed()
+            if key in cache:
+                await store.compact()
+        finally:
+            store.release()
+
+
+async def flush_periodically():
+    while True:
+        await sleep(FLUSH_INTERVAL)
+        try:
+            await flush_stores()
+            await compact_stores()
+        except Exception:
+            # whatever didn't make it to disk is still dirty and retried next time
+            logging.exception("Flushing stores failed")
+
+
+def shared_stamps(keys, connection):
+    """disk_stamp() of each (kind, key), but the version for SQLite stores."""
+    if connection is not None:
+        sqlite_versions = dict(connection.execute("SELECT name, version FROM versions"))
+    return {
+        (kind, key): sqlite_versions.get(key, 0)
+        if kind == "kv" and connection is not None
+        else disk_stamp(kind, key)
+        for kind, key in keys
+    }
+
+
+async def watch_shared_files():
+    """Bump the versions of stores and logs that other processes wrote to."""
+    if not STORE_SHARED and STORE_BACKEND != "sqlite":
+        return
+    while True:
+        await sleep(SHARED_POLL_INTERVAL)
+        # logs are only shared with STORE_SHARED
+        kinds = ["kv", "log"] if STORE_SHARED else ["kv"]
+        keys = [(kind, key) for kind in kinds for key in list(locks[kind])]
+        connection = None
+        if STORE_BACKEND == "sqlite":
+            if sqlite_connections:
+                connection = sqlite_connections.pop()
+            else:
+                connection = await to_thread.run_sync(sqlite_connect)
+        try:
+            current = await to_thread.run_sync(shared_stamps, keys, connection)
+        except BaseException:
+            if connection is not None:
+                connection.close()
+            raise
+        if connection is not None:
+            sqlite_connections.append(connection)
+        for kind, key in keys:
+            if seen.setdefault((kind, key), current[kind, key]) != current[kind, key]:
+                bump(kind, key)
+                seen[kind, key] = current[kind, key]
+
+
+# rows wait at most this many seconds (or until there are this many of them)
+# before their log's writer appends them in one go
+LOG_FLUSH_LATENCY = float(os.environ.get("LOG_FLUSH_LATENCY", 0.2))
+LOG_FLUSH_ROWS = int(os.environ.get("LOG_FLUSH_ROWS", 1000))
+# rows that can be queued before logging waits for the writer
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+# fsync after every batch
+LOG_FSYNC = os.environ.get("LOG_FSYNC", "no") == "yes"
+# bytes read per step when reading a log in blocks
+LOG_READ_BLOCK = 64 * 1024
+# the hot file is sealed into a new segment once it's this big or this old
+# (in seconds; 0 means no age limit)
+LOG_SEGMENT_BYTES = int(os.environ.get("LOG_SEGMENT_BYTES", 64 * 1024 * 1024))
+LOG_SEGMENT_AGE = float(os.environ.get("LOG_SEGMENT_AGE", 30 * 24 * 3600))
+# how sealed segments are compressed, and how often to look for new ones
+SEGMENT_OPENERS = {".gz": gzip.open, ".xz": lzma.open}
+LOG_COMPRESSION = {"gzip": ".gz", "lzma": ".xz", "none": None}[
+    os.environ.get("LOG_COMPRESSION", "gzip")
+]
+LOG_COMPRESS_INTERVAL = 60
+# a batch the writer fails to append is retried this often (a second apart)
+LOG_WRITE_ATTEMPTS = 3
+
+log_nursery = None  # where writer tasks run while the app is serving
+log_writers = {}  # key -> (send channel, Event set once the writer is done)
+# async functions called with (key, rows, position) once a batch is appended,
+# where position is what append_lines() returned for it
+log_listeners = []
+manifests = {}  # key -> {"segments": [...], "next": n, "hot_since": t}
+
+
+def read_manifest(key):
+    with open(LOGS_PATH / f"{key}.segments") as f:
+        return json.load(f)
+
+
+def load_manifest(key):
+    """The log's sealed segments (oldest first), with their row count and ts range."""
+    if key not in manifests:
+        try:
+            manifests[key] = read_manifest(key)
+        except FileNotFoundError:
+            manifests[key] = {"segments": [], "next": 1, "hot_since": time.time()}
+    return manifests[key]
+
+
+def save_manifest(key):
+    path = LOGS_PATH / f"{key}.segments"
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(manifests[key], f)
+    os.replace(f"{path}.tmp", path)
+
+
+def line_ts(line):
+    """The ts of an encoded row, or None if it has none (or doesn't even decode)."""
+    try:
+        row = json.loads(line)
+    except ValueError:
+        return None
+    ts = row.get("ts") if isinstance(row, dict) else None
+    return ts if isinstance(ts, str) else None
+
+
+def rotate(key):
+    """Seal the hot file as the next segment. Caller must hold the log's lock.
+
+    The manifest is saved first; if we die before the rename, the listed
+    segment just doesn't exist and its rows stay in the hot file.
+    """
+    manifest = load_manifest(key)
+    path = LOGS_PATH / key
+    min_ts = max_ts = None
+    rows = 0
+    with open(path, "rb") as f:
+        for line in f:
+            rows += 1
+            if (ts := line_ts(line)) is not None:
+                min_ts, max_ts = min(min_ts or ts, ts), max(max_ts or ts, ts)
+    name = f"{key}.{manifest['next']}"
+    manifest["segments"].append(
+        {"name": name, "rows": rows, "min_ts": min_ts, "max_ts": max_ts}
+    )
+    manifest["next"] += 1
+    manifest["hot_since"] = time.time()
+    save_manifest(key)
+    os.replace(path, LOGS_PATH / name)
+
+
+def append_lines(key, lines):
+    """Append to the hot file, rotating it first if it's due. Caller must hold the log's lock.
+
+    Returns where the lines went: [number of sealed segments before the hot
+    file, its size before the lines], see Log.before().
+    """
+    path = LOGS_PATH / key
+    with file_lock(LOGS_PATH / f"{key}.lock", fcntl.LOCK_EX):
+        if STORE_SHARED:
+            manifests.pop(key, None)  # another process may have rotated the log
+        manifest = load_manifest(key)
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if size and (
+            size >= LOG_SEGMENT_BYTES
+            or LOG_SEGMENT_AGE
+            and time.time() - manifest["hot_since"] >= LOG_SEGMENT_AGE
+        ):
+            rotate(key)
+            size = 0
+        if not size:
+            manifest["hot_since"] = time.time()
+            save_manifest(key)
+        text = "".join(f"{line}\n" for line in lines)
+        if size:
+            with open(path, "rb") as f:
+                f.seek(size - 1)
+                if f.read(1) != b"\n":
+                    text = f"\n{text}"  # end a torn last row, so it doesn't swallow ours
+        try:
+            with open(path, "a") as f:
+                f.write(text)
+                if LOG_FSYNC:
+                    f.flush()
+                    os.fsync(f.fileno())
+        except BaseException:
+            # don't leave part of the batch behind, it may be retried
+            with suppress(OSError):
+                os.truncate(path, size)
+            raise
+    return [len(manifest["segments"]), size]
+
+
+def log_files(key):
+    """The log's sealed segments and an open handle on its hot file (or None).
+
+    Caller must hold the log's lock, so a concurrent rotation can't make us
+    miss rows.
+    """
+    with file_lock(LOGS_PATH / f"{key}.lock", fcntl.LOCK_SH):
+        if STORE_SHARED:
+            manifests.pop(key, None)
+        segments = list(load_manifest(key)["segments"])
+        try:
+            hot = open(LOGS_PATH / key, "rb")
+        except FileNotFoundError:
+            hot = None
+    return segments, hot
+
+
+def open_segment(name):
+    """Open a sealed segment, whether or not it has been compressed yet.
+
+    Returns the file and whether it's compressed, or (None, False) if the
+    segment doesn't exist.
+    """
+    try:
+        return open(LOGS_PATH / name, "rb"), False
+    except FileNotFoundError:
+        pass
+    for suffix, opener in SEGMENT_OPENERS.items():
+        try:
+            return opener(LOGS_PATH / f"{name}{suffix}", "rb"), True
+        except FileNotFoundError:
+            pass
+    return None, False
+
+
+def compress_segment(name):
+    source = LOGS_PATH / name
+    if not os.path.exists(source):
+        return
+    target = LOGS_PATH / f"{name}{LOG_COMPRESSION}"
+    # another process may be compressing the same segment; both results are equal
+    tmp = f"{target}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(source, "rb") as f:
+            with SEGMENT_OPENERS[LOG_COMPRESSION](tmp, "wb") as out:
+                shutil.copyfileobj(f, out)
+        os.replace(tmp, target)
+        os.remove(source)  # readers that have it open keep reading it
+    except FileNotFoundError:
+        pass
+
+
+async def compress_logs():
+    if LOG_COMPRESSION is None:
+        return
+    for name in await to_thread.run_sync(os.listdir, LOGS_PATH):
+        if name.endswith(".segments"):
+            # straight from disk: sealed segments never change, and the cached
+            # manifest belongs to whoever holds the log's lock
+            manifest = await to_thread.run_sync(read_manifest, name[: -len(".segments")])
+            # the newest one stays as it is, so tail() can still seek backwards
+            # through it while the hot file has few rows after a rotation
+            for segment in manifest["segments"][:-1]:
+                await to_thread.run_sync(compress_segment, segment["name"])
+
+
+async def compress_logs_periodically():
+    while True:
+        await sleep(LOG_COMPRESS_INTERVAL)
+        try:
+            await compress_logs()
+        except Exception:
+            logging.exception("Compressing logs failed")
+
+
+def find_offset(f, ts):
+    """Offset of the first row with a ts >= the given one.
+
+    Bisects over byte offsets, looking at the first row starting at or after
+    each probe; rows without a ts (or that aren't objects) are skipped over.
+    """
+    low, high = 0, f.seek(0, os.SEEK_END)
+    while low < high:
+        middle = (low + high) // 2
+        f.seek(max(middle - 1, 0))
+        if middle:
+            f.readline()  # to the first line starting at or after middle
+        while line := f.readline():
+            if (row_ts := line_ts(line)) is not None:
+                break
+        if not line or row_ts >= ts:
+            high = middle
+        else:
+            low = f.tell()
+    f.seek(max(low - 1, 0))
+    if low:
+        f.readline()
+    return f.tell()
+
+
+def decode_rows(lines):
+    """The decoded lines, leaving out torn ones (the process died mid-append)."""
+    for line in lines:
+        if line:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                pass
+
+
+async def read_rows(f, size=None):
+    """Rows from the current position of an async file (up to size bytes), read in blocks."""
+    rest = b""
+    while size != 0 and (
+        chunk := await f.read(LOG_READ_BLOCK if size is None else min(LOG_READ_BLOCK, size))
+    ):
+        if size is not None:
+            size -= len(chunk)
+        *lines, rest = (rest + chunk).split(b"\n")
+        for row in decode_rows(lines):
+            yield row
+    for row in decode_rows([rest]):
+        yield row
+
+
+async def read_rows_reversed(f, compressed):
+    """Rows of an async file from last to first."""
+    if compressed:
+        # no cheap way to seek backwards; only older segments are compressed,
+        # which tail() rarely gets to
+        for row in decode_rows(reversed((await f.read()).split(b"\n"))):
+            yield row
+        return
+    position = await f.seek(0, os.SEEK_END)
+    rest = b""
+    while position > 0:
+        size = min(LOG_READ_BLOCK, position)
+        position -= size
+        await f.seek(position)
+        lines = (await f.read(size) + rest).split(b"\n")
+        rest = lines.pop(0)  # may continue in the previous block
+        for row in decode_rows(reversed(lines)):
+            yield row
+    for row in decode_rows([rest]):
+        yield row
+
+
+async def write_log(key, receive, done):
+    """Append rows queued for one log, batching rows from many requests."""
+    try:
+        async with receive:
+            async for line in receive:
+                batch = [line]
+                with move_on_after(LOG_FLUSH_LATENCY):
+                    try:
+                        while len(batch) < LOG_FLUSH_ROWS:
+                            batch.append(await receive.receive())
+                    except EndOfChannel:
+                        pass
+                for attempt in range(LOG_WRITE_ATTEMPTS):
+                    if attempt:
+                        await sleep(1)
+                    try:
+                        await write_batch(key, batch)
+                        break
+                    except Exception:
+                        logging.exception("Appending %d rows to log %s failed", len(batch), key)
+                else:
+                    logging.error("Dropped %d rows of log %s", len(batch), key)
+    finally:
+        done.set()
+
+
+async def write_batch(key, lines):
+    async with Log(key).lock:
+        position = await to_thread.run_sync(append_lines, key, lines)
+        bump("log", key)
+    if log_listeners:
+        rows = [json.loads(line) for line in lines]
+        for listener in log_listeners:
+            try:
+                await listener(key, rows, position)
+            except Exception:
+                logging.exception("Log listener %s failed for %s", listener.__qualname__, key)
+
+
+async def run_log_writers(task_status=TASK_STATUS_IGNORED):
+    global log_nursery
+    async with open_nursery() as log_nursery:
+        task_status.started()
+        await sleep_forever()
+
+
+async def close_logs():
+    """Stop accepting queued rows and wait until everything queued is written."""
+    global log_nursery
+    log_nursery = None
+    writers = list(log_writers.values())
+    log_writers.clear()
+    for send, done in writers:
+        await send.aclose()
+    for send, done in writers:
+        await done.wait()
+
+
+async def append_log(key, lines):
+    if log_nursery is None:
+        # not serving (or shutting down): write directly
+        await write_batch(key, lines)
+        return
+    if key not in log_writers:
+        send, receive = open_memory_channel(LOG_QUEUE_SIZE)
+        log_writers[key] = send, Event()
+        log_nursery.start_soon(write_log, key, receive, log_writers[key][1])
+    send, _ = log_writers[key]
+    for line in lines:
+        await send.send(line)
 
 
 class Log:
@@ -52,58 +1112,212 @@ class Log:
     async def log(self, data):
         if not self.in_context:
             async with self:
-                self.log(data)
+                await self.log(data)
         else:
             self.buffer.append(data)
 
     async def __aexit__(self, exc_type, exc, tb):
+        """Hand the rows to the log's writer; they reach the file shortly after."""
         try:
-            if exc is None:
-                await self.lock.acquire()
-                try:
-                    async with await self.path.open("a") as f:
-                        for row in self.buffer:
-                            await f.write(json.dumps(row))
-                            await f.write("\n")
-                finally:
-                    self.lock.release()
+            if exc is None and self.buffer:
+                await append_log(self.key, [json.dumps(row) for row in self.buffer])
         finally:
             self.buffer = []
             self.in_context = False
 
+    async def segments(self):
+        """The sealed segments, oldest first, and an open handle on the hot file.
+
+        Both are taken under the lock so a concurrent rotation can't make us
+        miss rows.
+        """
+        async with self.lock:
+            segments, hot = await to_thread.run_sync(log_files, self.key)
+        return segments, hot and wrap_file(hot)
+
+    async def open_segment(self, segment):
+        f, compressed = await to_thread.run_sync(open_segment, segment["name"])
+        return f and wrap_file(f), compressed
+
     async def __aiter__(self):
-        async with await self.path.open() as f:
-            async for line in f:
-                yield json.loads(line)
+        segments, hot = await self.segments()
+        try:
+            for segment in segments:
+                f, _ = await self.open_segment(segment)
+                if f:
+                    async with f:
+                        async for row in read_rows(f):
+                            yield row
+            if hot:
+                async for row in read_rows(hot):
+                    yield row
+        finally:
+            if hot:
+                await hot.aclose()
 
+    async def end(self):
+        """The position the next batch will be appended at, see before()."""
+        segments, hot = await self.segments()
+        if not hot:
+            return [len(segments), 0]
+        async with hot:
+            return [len(segments), await hot.seek(0, os.SEEK_END)]
 
-async def write_blob(data):
-    # automatic mode?
-    identifier = uuid.uuid4().hex
+    async def before(self, position):
+        """Rows appended before a position, as returned by append_lines().
+
+        That's all rows of the first position[0] segments, and the first
+        position[1] bytes of the file after them (sealed since, or still hot).
+        """
+        sealed, size = position
+        segments, hot = await self.segments()
+        try:
+            for segment in segments[:sealed]:
+                f, _ = await self.open_segment(segment)
+                if f:
+                    async with f:
+                        async for row in read_rows(f):
+                            yield row
+            if len(segments) > sealed:
+                f, _ = await self.open_segment(segments[sealed])
+            else:
+                f, hot = hot, None
+            if f:
+                async with f:
+                    async for row in read_rows(f, size):
+                        yield row
+        finally:
+            if hot:
+                await hot.aclose()
+
+    async def reverse(self):
+        """Rows from newest to oldest, reading the files backwards in blocks."""
+        segments, hot = await self.segments()
+        if hot:
+            async with hot:
+                async for row in read_rows_reversed(hot, compressed=False):
+                    yield row
+        for segment in reversed(segments):
+            f, compressed = await self.open_segment(segment)
+            if f:
+                async with f:
+                    async for row in read_rows_reversed(f, compressed):
+                        yield row
+
+    async def between(self, start=None, stop=None):
+        """Rows with start <= ts < stop (datetimes or timestamp() strings).
+
+        Relies on rows being appended in ts order: segments whose ts range
+        lies outside the window are skipped, and within uncompressed files
+        the start is found by bisection. Rows without a ts are included when
+        they come after the first row inside the window; rows that aren't
+        objects are left out.
+        """
+        if isinstance(start, datetime):
+            start = timestamp(start)
+        if isinstance(stop, datetime):
+            stop = timestamp(stop)
+        segments, hot = await self.segments()
+        files = []
+        for segment in segments:
+            if start and segment["max_ts"] and segment["max_ts"] < start:
+                continue
+            if stop and segment["min_ts"] and segment["min_ts"] >= stop:
+                break
+            files.append(segment)
+        files.append(None)  # the hot file
+        try:
+            for segment in files:
+                if segment is None:
+                    f, compressed = hot, False
+                else:
+                    f, compressed = await self.open_segment(segment)
+                if not f:
+                    continue
+                async with f:
+                    if start and not compressed:
+                        await f.seek(await to_thread.run_sync(find_offset, f.wrapped, start))
+                    started = not start
+                    async for row in read_rows(f):
+                        if not isinstance(row, dict):
+                            continue
+                        ts = row.get("ts")
+                        if not isinstance(ts, str):
+                            ts = None
+                        if not started:
+                            if ts is None or ts < start:
+                                continue
+                            started = True
+                        if stop and ts is not None and ts >= stop:
+                            return
+                        yield row
+        finally:
+            if hot:
+                await hot.aclose()
+
+    async def tail(self, n):
+        """The last n rows, oldest first. Only those rows are decoded."""
+        rows = []
+        if n <= 0:
+            return rows
+        rows_reversed = self.reverse()
+        try:
+            async for row in rows_reversed:
+                rows.append(row)
+                if len(rows) == n:
+                    break
+        finally:
+            await rows_reversed.aclose()
+        return rows[::-1]
+
+
+def encode_blob(data):
     if isinstance(data, str):
-        fmode, conversion, mode = "w", None, "string"
-    elif isinstance(data, bytes):
-        fmode, conversion, mode = "wb", None, "bytes"
-    else:
-        fmode, conversion, mode = "wb", pickle.dumps, "pickle"
+        return "string", data.encode()
+    if isinstance(data, bytes):
+        return "bytes", data
+    return "pickle", pickle.dumps(data)
+
 
-    conversion = conversion or (lambda x: x)
+def decode_blob(mode, payload):
+    if mode == "string":
+        return payload.decode()
+    if mode == "pickle":
+        return pickle.loads(payload)
+    return payload
 
-    async with await (BLOB_PATH / identifier).open(fmode) as f:
-        await f.write(conversion(data))
 
-    async with Store("blobs") as s:
-        s[identifier] = mode
+async def write_blob(data):
+    """Store data and return its identifier, which is derived from its content.
+
+    The mode is kept in a header line of the blob itself, so saving the same
+    thing twice yields the same blob.
+    """
+    mode, payload = encode_blob(data)
+    content = BLOB_MAGIC + mode.encode() + b"\n" + payload
+    identifier = hashlib.sha256(content).hexdigest()[:32]
+    path = BLOB_PATH / identifier
+    if not await path.exists():
+        tmp_path = BLOB_PATH / f"{identifier}.{uuid.uuid4().hex}.tmp"
+        await tmp_path.write_bytes(content)
+        await tmp_path.replace(path)
     return identifier
 
 
 async def read_blob(identifier, mode="auto"):
-    # raw, string, pickle?
-    if mode == "auto":
-        async with Store("blobs") as s:
-            mode = s[identifier]
-
-    fmode = "r" if mode == "string" else "rb"
-    conversion = pickle.loads if mode == "pickle" else (lambda x: x)
-    async with await (BLOB_PATH / identifier).open(fmode) as f:
-        return conversion(await f.read())
+    """Read a blob. Decoded blobs are cached, so don't modify what you get."""
+    if (data := blob_cache.get(identifier, MISSING)) is not MISSING:
+        return data
+    content = await (BLOB_PATH / identifier).read_bytes()
+    if content.startswith(BLOB_MAGIC):
+        header, _, payload = content.partition(b"\n")
+        mode = header[len(BLOB_MAGIC) :].decode()
+    else:
+        # written before blobs had headers
+        payload = content
+        if mode == "auto":
+            async with Store.read("blobs") as s:
+                mode = s[identifier]
+    data = decode_blob(mode, payload)
+    blob_cache.put(identifier, data, len(payload))
+    return data
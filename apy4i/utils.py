@@ -1,7 +1,13 @@
+import os
+import logging
+import hashlib
 from statistics import mean
+from functools import wraps
+from inspect import iscoroutinefunction
+from collections import OrderedDict
 from datetime import datetime, timezone, timedelta
-
-TOO_LONG_AGO = datetime(1970, 1, 1)
+from trio import TASK_STATUS_IGNORED, Event, open_nursery, sleep_forever
+from quart import request, make_response
 
 
 def elo(team_a, team_b, outcome, k=16, rounding=False):
@@ -25,20 +31,166 @@ def elo(team_a, team_b, outcome, k=16, rounding=False):
     )
 
 
-def timestamp():
-    return datetime.now(tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%f%z")
+class LRU:
+    """Least-recently-used mapping, bounded by the total size of its values."""
+
+    def __init__(self, max_size, size=lambda value: 1):
+        self.max_size = max_size
+        self.size = size
+        self.entries = OrderedDict()  # key -> (value, size)
+        self.total = 0
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            return default
+        self.entries.move_to_end(key)
+        return self.entries[key][0]
+
+    def put(self, key, value, size=None):
+        size = self.size(value) if size is None else size
+        self.pop(key)
+        if size > self.max_size:
+            return
+        self.entries[key] = value, size
+        self.total += size
+        while self.total > self.max_size:
+            _, (_, evicted) = self.entries.popitem(last=False)
+            self.total -= evicted
+
+    def pop(self, key, default=None):
+        if key not in self.entries:
+            return default
+        value, size = self.entries.pop(key)
+        self.total -= size
+        return value
+
+
+def timestamp(dt=None):
+    dt = dt.astimezone(timezone.utc) if dt else datetime.now(tz=timezone.utc)
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.%f%z")
+
+
+# part of every ETag, so tags from before a restart (when versions start over) never match
+ETAG_EPOCH = os.urandom(8).hex()
+
+
+def etagged(tag):
+    """Answer a matching If-None-Match with a 304, without running the view.
+
+    tag() returns something that changes whenever the response would (usually
+    storage versions), or None to not tag the response at all.
+    """
+
+    def decorator(afn):
+        @wraps(afn)
+        async def wrapper(*args, **kwargs):
+            parts = tag()
+            if parts is None:
+                return await afn(*args, **kwargs)
+            etag = hashlib.sha256(repr((ETAG_EPOCH, request.path, parts)).encode()).hexdigest()
+            if request.if_none_match.contains(etag):
+                return "", 304, {"ETag": f'"{etag}"'}
+            response = await make_response(await afn(*args, **kwargs))
+            response.set_etag(etag)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+refresh_nursery = None  # where stale cache entries are refreshed while the app is serving
+
 
+async def run_refreshes(task_status=TASK_STATUS_IGNORED):
+    global refresh_nursery
+    try:
+        async with open_nursery() as refresh_nursery:
+            task_status.started()
+            await sleep_forever()
+    finally:
+        refresh_nursery = None
+
+
+def cached(max_age=timedelta(minutes=5), max_entries=256, stale_for=timedelta(0)):
+    """Cache results per arguments for max_age, keeping at most max_entries.
+
+    Works on plain and async functions. For async ones, only one caller
+    computes a missing or expired entry while the others wait for it, and an
+    entry that expired less than stale_for ago is returned right away while a
+    background task refreshes it (only while the app is serving, otherwise it's
+    recomputed like a missing one). Counters end up in cached.stats.
+    """
 
-def cached(max_age=timedelta(minutes=5)):
     def decorator(fn):
+        entries = LRU(max_entries)  # key -> (value, ts)
+        refreshing = {}  # key -> Event set once the running computation is done
+        stats = cached.stats[f"{fn.__module__}.{fn.__qualname__}"] = {
+            "hits": 0,
+            "misses": 0,
+            "stale": 0,
+        }
+
+        @wraps(fn)
         def wrapper(*args, **kwargs):
-            key = (fn, tuple(args), tuple(kwargs.items()))
+            key = (tuple(args), tuple(kwargs.items()))
             now = datetime.now()
-            entry, ts = cached.entries.get(key, (None, TOO_LONG_AGO))
-            if ts < now - max_age:
-                entry = fn(*args, **kwargs)
-                cached.entries[key] = (entry, now)
-            return entry
-        return wrapper
+            entry = entries.get(key)
+            if entry and entry[1] >= now - max_age:
+                stats["hits"] += 1
+                return entry[0]
+            stats["misses"] += 1
+            value = fn(*args, **kwargs)
+            entries.put(key, (value, now))
+            return value
+
+        async def compute(key, args, kwargs):
+            # the caller has put an Event into refreshing[key]
+            try:
+                value = await fn(*args, **kwargs)
+                entries.put(key, (value, datetime.now()))
+                return value
+            finally:
+                refreshing.pop(key).set()
+
+        async def refresh(key, args, kwargs):
+            try:
+                await compute(key, args, kwargs)
+            except Exception:
+                logging.exception("Refreshing %s failed", fn.__qualname__)
+
+        @wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            key = (tuple(args), tuple(kwargs.items()))
+            while True:
+                now = datetime.now()
+                entry = entries.get(key)
+                if entry and entry[1] >= now - max_age:
+                    stats["hits"] += 1
+                    return entry[0]
+                if refresh_nursery and entry and entry[1] >= now - max_age - stale_for:
+                    stats["stale"] += 1
+                    if key not in refreshing:
+                        refreshing[key] = Event()
+                        refresh_nursery.start_soon(refresh, key, args, kwargs)
+                    return entry[0]
+                if key not in refreshing:
+                    break
+                # someone else is computing it; if they fail, we try
+                await refreshing[key].wait()
+            stats["misses"] += 1
+            refreshing[key] = Event()
+            return await compute(key, args, kwargs)
+
+        return async_wrapper if iscoroutinefunction(fn) else wrapper
+
     return decorator
-cached.entries = {}
+
+
+cached.stats = {}
@@ -0,0 +1,81 @@
+"""Several worker processes updating shared stores and logs (STORE_SHARED).
+
+Every update is a read-modify-write of a Store plus a Log row, like a krank
+submission. Afterwards the totals are checked, so lost updates would show.
+
+Run from the repository root: python benchmarks/multiworker.py
+"""
+import sys
+import tempfile
+import multiprocessing
+from time import perf_counter
+
+import trio
+
+sys.path.insert(0, ".")
+from apy4i import storage  # noqa: E402
+
+UPDATES = 300  # per worker
+LEAGUES = 8  # stores (and logs) the updates are spread over
+
+
+def configure(tmp):
+    storage.STORE_SHARED = True
+    storage.STORE_PATH = trio.Path(tmp) / "store"
+    storage.LOGS_PATH = trio.Path(tmp) / "logs"
+    for state in storage.locks["kv"], storage.locks["log"], storage.cache, storage.manifests:
+        state.clear()
+
+
+async def update(worker, leagues):
+    for i in range(UPDATES):
+        key = f"league{i % leagues}"
+        async with storage.Store(key) as ranks:
+            async with storage.Log(key) as log:
+                player = f"player{(worker + i) % 5}"
+                ranks[player] = ranks.get(player, 1000) + 1
+                await log.log({"worker": worker, "player": player})
+
+
+def work(tmp, worker, leagues):
+    configure(tmp)
+    trio.run(update, worker, leagues)
+
+
+async def totals(leagues):
+    games = rows = 0
+    for n in range(leagues):
+        async with storage.Store.read(f"league{n}") as ranks:
+            games += sum(score - 1000 for score in ranks.values())
+        async for _ in storage.Log(f"league{n}"):
+            rows += 1
+    return games, rows
+
+
+def main():
+    print(f"{'workers':>8} {'leagues':>8} {'updates/s':>10} {'lost':>6}")
+    for leagues in LEAGUES, 1:
+        for workers in 1, 2, 4:
+            with tempfile.TemporaryDirectory() as tmp:
+                configure(tmp)
+                for path in storage.STORE_PATH, storage.LOGS_PATH:
+                    trio.run(path.mkdir)
+                processes = [
+                    multiprocessing.Process(target=work, args=(tmp, worker, leagues))
+                    for worker in range(workers)
+                ]
+                start = perf_counter()
+                for process in processes:
+                    process.start()
+                for process in processes:
+                    process.join()
+                elapsed = perf_counter() - start
+                configure(tmp)
+                games, rows = trio.run(totals, leagues)
+                expected = workers * UPDATES
+                lost = max(expected - games, expected - rows)
+                print(f"{workers:>8} {leagues:>8} {expected / elapsed:>10.0f} {lost:>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""Write latency of a one-key change: full rewrite vs. journaled Store.
+
+Run from the repository root: python benchmarks/store_write.py
+"""
+import sys
+import tempfile
+from time import perf_counter
+
+import trio
+
+sys.path.insert(0, ".")
+from apy4i import storage  # noqa: E402
+
+ROUNDS = 50
+
+
+async def measure(key, size):
+    storage.cache.pop(key, None)
+    async with storage.Store(key) as data:
+        data.update({f"key{i}": {"status": "waiting", "n": i} for i in range(size)})
+    await storage.flush_stores()
+    await storage.compact_stores(force=True)
+
+    start = perf_counter()
+    for i in range(ROUNDS):
+        async with storage.Store(key) as data:
+            data[f"key{i}"] = {"status": "warned", "n": i}
+        await storage.flush_stores()
+    return (perf_counter() - start) / ROUNDS
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        storage.STORE_PATH = trio.Path(tmp)
+        storage.JOURNALED.clear()
+        storage.JOURNALED.add("journaled")
+        print(f"{'keys':>8} {'rewrite':>12} {'journal':>12}")
+        for size in 1_000, 10_000, 100_000:
+            rewrite = await measure("rewritten", size)
+            journal = await measure("journaled", size)
+            print(f"{size:>8} {rewrite * 1000:>10.3f}ms {journal * 1000:>10.3f}ms")
+
+
+if __name__ == "__main__":
+    trio.run(main)